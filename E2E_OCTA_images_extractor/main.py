@@ -13,6 +13,10 @@ import cv2
 # System packages
 import os
 import sys
+import math
+import mmap
+import zipfile
+import multiprocessing
 sys.path.append('../Common_utils')
 
 # Base interfaz class
@@ -27,6 +31,65 @@ class CustomFolderSelectorApp(FolderSelectorApp):
         super().create_widgets()  # Llama al método create_widgets de la clase base
         self.extensions_list = ('.E2E', '.e2e')
 
+        # Agregar un pequeño diccionario con las traducciones
+        translations = {
+                "de": {
+                    "parallel_text": "Parallele Verarbeitung"
+                },
+                "es": {
+                    "parallel_text": "Procesamiento Paralelo"
+                },
+                "default": {
+                    "parallel_text": "Parallel Processing"
+                }
+            }
+
+        # Agregar check button
+        self.parallel_var = tk.BooleanVar()
+        self.parallel_button = tk.Checkbutton(self.main_frame, text=translations[self.system_locale]['parallel_text'], variable=self.parallel_var)
+        self.parallel_button.grid(row=4, column=0, columnspan=2, padx=0, pady=5)
+
+    def run_function(self):
+        # Tk variables are read here, the extraction runs in another thread
+        self.parallel_extraction = self.parallel_var.get()
+        super().run_function()
+
+    def default_function_to_execute(self, folder_path, que=None, recursive_search=False, extensions_list=('.E2E', '.e2e')):
+        """
+        Extracts the OCTA images of every E2E file in the folder, in a process pool if parallel processing is selected.
+
+        Parameters:
+            folder_path (str): Path of the source folder.
+            que (queue.Queue, optional): Processing queue to report progress. Default is None.
+            recursive_search (bool, optional): Indicates whether subfolders are also searched.
+        """
+        if not getattr(self, 'parallel_extraction', False):
+            return super().default_function_to_execute(folder_path, que, recursive_search, extensions_list)
+
+        # Añadir '_output' al nombre de la carpeta raíz
+        root_folder_name = os.path.basename(folder_path)
+        root_folder_parent = os.path.dirname(folder_path)
+        formatted_root_path = os.path.join(root_folder_parent, root_folder_name + '_output')
+
+        # Recorrer las carpetas y archivos
+        tasks = []
+        for current_root, _, files in os.walk(folder_path):
+            files = [file for file in files if file.lower().endswith(extensions_list)]
+            for file in files:
+                file_path = os.path.join(current_root, file)
+                relative_dir = os.path.dirname(os.path.relpath(file_path, folder_path))
+                tasks.append((file_path, os.path.join(formatted_root_path, relative_dir)))
+
+            # Si no es búsqueda recursiva, salir del bucle después de la primera iteración
+            if not recursive_search:
+                break
+
+        # Set success status
+        if tasks:
+            extract_OCTA_from_e2e_files(tasks, que=que)
+        if que:
+            que.put(len(tasks) > 0)
+
 
 class StructureParser(object):
     
@@ -37,6 +100,8 @@ class StructureParser(object):
 
         self.f = f
         self.parse_directory()
+        self.build_indexes()
+        self.open_view()
         self.define_knowledge()
 
 
@@ -69,6 +134,12 @@ class StructureParser(object):
             'type' / c.Int32ul,
             'id' / c.Bytes(4) 
         )
+        # Same layout as direntry_construct, to decode a whole directory block at once
+        self.direntry_dtype = np.dtype([
+            ('position', '<u4'), ('start', '<u4'), ('size', '<u4'), ('padding', 'V4'),
+            ('patient_id', '<u4'), ('study_id', '<u4'), ('series_id', '<u4'), ('slice_id', '<u4'),
+            ('indicator', '<u2'), ('unknown1', '<u2'), ('type', '<u4'), ('id', 'V4'),
+        ])
         
     def define_data_constructs(self):
         self.unknown_0x3b_construct = c.Struct(
@@ -96,29 +167,124 @@ class StructureParser(object):
 
     def parse_directory(self):
         self.header = self.header_construct.parse_stream(self.f)
-        self.directory = []
 
+        # Reuse the entry table of a previous run if the file did not change
+        directory = self.load_directory_index()
+        if directory is None:
+            directory = self.read_directory()
+            self.save_directory_index(directory)
+        self.directory = directory
+
+
+    def read_directory(self):
         maindir = self.directory_construct.parse_stream(self.f)
         prev = maindir.last
 
-        entry_count = 0
+        # Directory blocks are chained from the last one, each block is decoded in one call
+        blocks = []
         while prev != 0:
             self.f.seek(prev)
             thisdir = self.directory_construct.parse_stream(self.f)
-            entries = []
-            
-            for i in range(thisdir.num_entries):
-                thisentry = self.direntry_construct.parse_stream(self.f)
-                if thisentry.type > 0 :
-                    entries.append(thisentry)
-                    entry_count += 1
-                    
-            self.directory.extend(reversed(entries))
+            block_data = self.f.read(thisdir.num_entries * self.direntry_dtype.itemsize)
+            entries = np.frombuffer(block_data, dtype=self.direntry_dtype)
+            blocks.append(entries[entries['type'] > 0][::-1])
             prev = thisdir.prev
-            
-        self.directory.reverse()
+
+        if not blocks:
+            return np.zeros(0, dtype=self.direntry_dtype)
+        return np.concatenate(blocks)[::-1]
+
+
+    def get_index_path(self):
+        # Only streams backed by a file on disk get a sidecar index (not BytesIO or other unnamed streams)
+        name = getattr(self.f, 'name', None)
+        if not isinstance(name, str) or not os.path.isfile(name):
+            return None
+        return f"{name}.index.npz"
+
+
+    def get_file_stat(self):
+        try:
+            return os.stat(self.f.name)
+        except (AttributeError, OSError):
+            return None
+
+
+    def load_directory_index(self):
+        # The index is only valid for the same file size and modification time
+        index_path = self.get_index_path()
+        if index_path is None or not os.path.exists(index_path):
+            return None
+        file_stat = self.get_file_stat()
+        if file_stat is None:
+            return None
+        try:
+            with np.load(index_path) as index:
+                if int(index['file_size']) != file_stat.st_size or int(index['mtime_ns']) != file_stat.st_mtime_ns:
+                    return None
+                directory = index['directory']
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+        return directory if directory.dtype == self.direntry_dtype else None
+
+
+    def save_directory_index(self, directory):
+        # Saved through a temporary file, a folder without write access just skips the index
+        index_path = self.get_index_path()
+        file_stat = self.get_file_stat()
+        if index_path is None or file_stat is None:
+            return
+        try:
+            with open(index_path + '.tmp', 'wb') as index_file:
+                np.savez(index_file, directory=directory, file_size=file_stat.st_size, mtime_ns=file_stat.st_mtime_ns)
+            os.replace(index_path + '.tmp', index_path)
+        except OSError:
+            pass
     
 
+    def build_indexes(self):
+        # Entry positions for every value of the queryable fields, in directory order
+        self.indexes = {}
+        for field in ('patient_id', 'study_id', 'series_id', 'slice_id', 'type'):
+            values = self.directory[field]
+            order = np.argsort(values, kind='stable')
+            keys, starts = np.unique(values[order], return_index=True)
+            self.indexes[field] = dict(zip(keys.tolist(), np.split(order, starts[1:])))
+
+
+    def open_view(self):
+        # Map the file read-only so entry payloads are sliced without copies
+        try:
+            self.mmap = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mmap)
+        except (OSError, ValueError):
+            self.mmap = None
+            self.view = None
+
+
+    def get_entry_data(self, entry):
+        start = int(entry['start'])
+        size = int(entry['size'])
+        if self.view is not None:
+            return self.view[start:start + size]
+        # Streams that can not be mapped fall back to a regular read
+        self.f.seek(start)
+        return self.f.read(size)
+
+
+    def close(self):
+        # Images still referencing the map keep it alive until they are freed
+        if self.mmap is None:
+            return
+        try:
+            self.view.release()
+            self.mmap.close()
+        except BufferError:
+            pass
+        self.mmap = None
+        self.view = None
+
+
     def get_knowledge(self, t):
         return self.knowledge.get(hex(t), {'info':f"Unknown ({hex(t)})"})
 
@@ -130,84 +296,190 @@ class StructureParser(object):
     
 
     def get_deepth_name(self, entry):
-        if hex(entry.type) == '0x2760':
+        if hex(entry['type']) == '0x2760':
             deep_name = 'SVC'
-        if hex(entry.type) == '0x2761':
+        if hex(entry['type']) == '0x2761':
             deep_name = 'DVC'
-        if hex(entry.type) == '0x2762':
+        if hex(entry['type']) == '0x2762':
             deep_name = 'AVC'
         return deep_name
 
 
+    def get_raster_size(self, n_bytes):
+        # The directory entries have no width or height, only square RGBA rasters (512x512, 1024x1024...) are decoded
+        side = math.isqrt(n_bytes // 4)
+        if n_bytes % 4 != 0 or side * side * 4 != n_bytes:
+            raise ValueError(f"{n_bytes} bytes is not a square RGBA raster")
+        return side, side
+
+
     def read_rgba_image(self, data):
-        # Parse image
-        rgba_image_construct = c.Struct('raster' / c.Bytes(len(data)))
-        im = rgba_image_construct.parse(data)
-        cols, rows = 512, 512
-        # print(len(data))
-        img = np.zeros((rows, cols, 3), dtype=np.uint8)
-        ct = 0
-
-        # Fill image
-        for i in range(rows):
-            for j in range(cols):
-                for k in range(3):
-                    img[i,j,k] = int(data[ct+k])
-                ct += 4
-        
-        # Move error displacement image
+        # View the raster bytes as RGBA pixels without copying them
+        rows, cols = self.get_raster_size(len(data))
+        rgba = np.frombuffer(data, dtype=np.uint8).reshape(rows, cols, 4)
+
+        # Drop alpha and move error displacement image
         displacement = 15 # 14 16
-        img_f = np.zeros((rows, cols, 3), dtype=np.uint8)
-        img_f[:,:-displacement,:] = img[:, displacement:, :]
-        img_f[:, -displacement:,:] = img[:, :displacement, :]
+        img = np.roll(rgba[:, :, :3], -displacement, axis=1)
 
-        im.raster = img_f
-        return im
+        return c.Container(raster=img)
     
 
-    def save(self, output_folder, hexcodes):
-        # Iterate over directories avoiding unnecesary data
-        for i in range(len(self.directory)):
+    def get_type_code(self, t):
+        # Types are given as numbers, hex strings ('0x2761') or OCTA layer names ('DVC')
+        layers = {'SVC': 0x2760, 'DVC': 0x2761, 'AVC': 0x2762}
+        if isinstance(t, str):
+            return layers[t.upper()] if t.upper() in layers else int(t, 16)
+        return int(t)
+
+
+    def select(self, patient_id=None, study_id=None, series_id=None, slice_id=None, types=None):
+        """
+        Directory positions of the entries matching every given filter, in directory order.
+
+        Parameters:
+            patient_id, study_id, series_id, slice_id (int, optional): Ids to match. Default is any.
+            types (int, str or list, optional): Entry type or types to match. Default is any.
+        """
+        filters = {'patient_id': patient_id, 'study_id': study_id, 'series_id': series_id, 'slice_id': slice_id}
+        if types is not None:
+            types = [types] if isinstance(types, (int, np.integer, str)) else types
+            filters['type'] = [self.get_type_code(t) for t in types]
+
+        selected = None
+        for field, values in filters.items():
+            if values is None:
+                continue
+            values = values if isinstance(values, (list, tuple, set)) else [values]
+            matches = [self.indexes[field][v] for v in values if v in self.indexes[field]]
+            matches = np.sort(np.concatenate(matches)) if matches else np.zeros(0, dtype=np.int64)
+            selected = matches if selected is None else np.intersect1d(selected, matches, assume_unique=True)
+        return np.arange(len(self.directory)) if selected is None else selected
+
+
+    def query(self, patient_id=None, study_id=None, series_id=None, slice_id=None, types=None, log=print):
+        """
+        Lazily decodes the entries matching the filters of select(), visited in file offset order.
+        Entries that can not be decoded are skipped with a message to log.
+
+        Yields:
+            entry (np.void): Directory entry.
+            item_data (dict): Decoded payload, e.g. {'raster': image} for OCTA images.
+        """
+        selected = self.select(patient_id, study_id, series_id, slice_id, types)
+        selected = selected[np.argsort(self.directory['start'][selected], kind='stable')]
+        for i in selected:
             entry = self.directory[i]
-            if hex(entry.type) not in hexcodes:
+            kl = self.get_knowledge(entry['type'])
+            if 'parse' not in kl:
+                continue
+            try:
+                item_data = kl['parse'](self.get_entry_data(entry))
+            except ValueError as e:
+                log(f"Entry skipped - {hex(entry['type'])} at offset {entry['start']}: {e}")
                 continue
+            yield entry, item_data
+
+
+    def get_lateralities(self, indexes):
+        # Laterality of each entry by file offset, taken from the last 0x3b entry before it in the directory
+        series_data = self.select(types=0x3b)
+        previous = np.searchsorted(series_data, indexes) - 1
+        lateralities = {}
+        for p in np.unique(previous[previous >= 0]):
+            entry = self.directory[series_data[p]]
+            item_data = self.get_knowledge(entry['type'])['parse'](self.get_entry_data(entry))
+            lateralities[p] = 'OD' if item_data['laterality'] == 'R' else 'OS'
+        return {start: lateralities.get(p) for start, p in zip(self.directory['start'][indexes].tolist(), previous.tolist())}
+
+
+    def save(self, output_folder, hexcodes, log=print):
+        # Decode only the requested images, the saved filenames are returned
+        saved = []
+        image_types = [h for h in hexcodes if h != '0x3b']
+        lateralities = self.get_lateralities(self.select(types=image_types)) if '0x3b' in hexcodes else {}
+
+        # Images are visited in file offset order so the reads are sequential
+        for entry, item_data in self.query(types=image_types, log=log):
+            laterality = lateralities.get(int(entry['start']))
 
             # Get ids
-            patient_id = self.get_actual_id(entry.patient_id)
-            study_id = self.get_actual_id(entry.study_id)
-            series_id = self.get_actual_id(entry.series_id)
-                             
-            # Get knowledge and parse data
-            kl = self.get_knowledge(entry.type)
-            self.f.seek(entry.start)
-            entry_data = self.f.read(entry.size)
+            patient_id = self.get_actual_id(entry['patient_id'])
+            study_id = self.get_actual_id(entry['study_id'])
+            series_id = self.get_actual_id(entry['series_id'])
             item = dict()
-            item_data = kl['parse'](entry_data)
-            
-            # Get laterality and OCTA images
-            if hex(entry.type) == '0x3b':
-                laterality = item_data['laterality']
-                laterality = 'OD' if laterality == 'R' else 'OS'
-            else:
-                item['data'] = {}
-                for k, v in item_data.items():
-                    if k == 'raster':
-                        deep_name = self.get_deepth_name(entry)
-                        filename = f"{patient_id}_{study_id}_{series_id}_{deep_name}_{laterality}.png"
-                        filename = os.path.join(output_folder, filename)
-                        cv2.imwrite(filename, v)
-                        print(f'Image saved - {filename}')
-
-
-
-def extract_OCTA_from_e2e_folder(file_path, formatted_relative_path):
+
+            # Get OCTA images
+            item['data'] = {}
+            for k, v in item_data.items():
+                if k == 'raster':
+                    deep_name = self.get_deepth_name(entry)
+                    filename = f"{patient_id}_{study_id}_{series_id}_{deep_name}_{laterality}.png"
+                    filename = os.path.join(output_folder, filename)
+                    cv2.imwrite(filename, v)
+                    saved.append(filename)
+                    log(f'Image saved - {filename}')
+        return saved
+
+
+
+def extract_OCTA_from_e2e_folder(file_path, formatted_relative_path, log=print):
     # Crear carpeta si no existe
     os.makedirs(formatted_relative_path, exist_ok=True)
 
     # Ejecutar función principal
     with open(file_path, 'rb') as f:
         e2efile = StructureParser(f)
-        e2efile.save(formatted_relative_path, ['0x3b', '0x2760', '0x2761', '0x2762'])
+        try:
+            return e2efile.save(formatted_relative_path, ['0x3b', '0x2760', '0x2761', '0x2762'], log=log)
+        finally:
+            e2efile.close()
+
+
+def extract_e2e_file_task(task):
+    # Pool worker: the log lines are returned to be printed in input order
+    file_path, formatted_relative_path = task
+    lines = []
+    try:
+        saved = extract_OCTA_from_e2e_folder(file_path, formatted_relative_path, log=lines.append)
+        return {'file': file_path, 'images': len(saved), 'lines': lines, 'error': None}
+    except Exception as e:
+        return {'file': file_path, 'images': 0, 'lines': lines, 'error': f"{type(e).__name__}: {e}"}
+
+
+def extract_OCTA_from_e2e_files(tasks, workers=None, que=None):
+    """
+    Extracts the OCTA images of several E2E files in a process pool.
+
+    Parameters:
+        tasks (list): (file_path, formatted_relative_path) pairs.
+        workers (int, optional): Number of processes. Default is the number of CPUs.
+        que (queue.Queue, optional): Processing queue to report progress. Default is None.
+
+    Returns:
+        results (list): Dictionary per file, in input order, with the images extracted and the error if it failed.
+    """
+    workers = max(1, min(workers or os.cpu_count() or 1, len(tasks)))
+
+    # Results arrive in input order, so the log of each file is printed as a block
+    results = []
+    with multiprocessing.Pool(workers) as pool:
+        for counter, result in enumerate(pool.imap(extract_e2e_file_task, tasks), 1):
+            if que:
+                que.put(' ' + str(counter) + ' / ' + str(len(tasks)))
+            for line in result['lines']:
+                print(line)
+            if result['error']:
+                print(f"Error in {result['file']} - {result['error']}")
+            results.append(result)
+
+    # Summary
+    failures = [result for result in results if result['error']]
+    print(f"\nExtracted {sum(result['images'] for result in results)} images from {len(results)} files, {len(failures)} failed")
+    for result in results:
+        status = f"FAILED ({result['error']})" if result['error'] else f"{result['images']} images"
+        print(f"  {result['file']}: {status}")
+    return results
 
 
 def main():
@@ -217,4 +489,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Pool workers in the packaged executable
     main()
\ No newline at end of file
@@ -0,0 +1,184 @@
+# System and basic packages
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+
+# Array and image manipulation packages
+import numpy as np
+import cv2
+
+# Converter functions
+from main import (load_config, get_current_rss_bytes, read_large_file_in_batches, read_large_file_in_batches_memmap,
+                  register_images, average_bscans_streaming, normalize_image_float32, normalize_image_complex64,
+                  save_bscan_image)
+
+
+# Synthetic data
+def generate_synthetic_volume(filepath: str, data_format: str, width: int, height: int, num_bscans: int, seed: int = 0) -> None:
+    """Writes a synthetic HoloOCT .raw volume: a smooth layered structure with speckle and small lateral jitter.
+
+    B-scans are generated and written in chunks, so large volumes don't have to fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    depth_profile = np.exp(-np.linspace(0, 4, height, dtype=np.float32)) * (1 + 0.5 * np.sin(np.linspace(0, 40, height, dtype=np.float32)))
+    structure = cv2.GaussianBlur(rng.random((width, height), dtype=np.float32), (0, 0), 3) * depth_profile * 10
+    chunk_size = 32
+    with open(filepath, 'wb') as file:
+        for start in range(0, num_bscans, chunk_size):
+            n_chunk = min(chunk_size, num_bscans - start)
+            shifts = rng.integers(-2, 3, size=n_chunk)
+            chunk = np.stack([np.roll(structure, shift, axis=0) for shift in shifts])
+            chunk *= rng.exponential(1.0, size=chunk.shape).astype(np.float32) # Speckle
+            if data_format == 'complex64':
+                phase = rng.uniform(0, 2 * np.pi, size=chunk.shape).astype(np.float32)
+                chunk = (chunk * np.exp(1j * phase)).astype(np.complex64)
+            chunk.tofile(file)
+
+
+# Timing
+class RssSampler:
+    """
+    Samples the resident memory of the process in a background thread while a stage runs.
+
+    Methods:
+        - __enter__(): Records the RSS before the stage and starts sampling.
+        - __exit__(): Stops sampling and records the RSS after the stage.
+        - memory(): Returns the RSS before the stage, the peak increase during it and the increase after it, in MB.
+    """
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def _sample(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.peak = max(self.peak, get_current_rss_bytes() or 0)
+
+    def __enter__(self):
+        self.before = self.peak = get_current_rss_bytes() or 0
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop_event.set()
+        self.thread.join()
+        self.after = get_current_rss_bytes() or 0
+        self.peak = max(self.peak, self.after)
+
+    def memory(self) -> dict:
+        if not self.before:
+            return {'rss_before_mb': None, 'peak_rss_delta_mb': None, 'rss_delta_mb': None}
+        return {'rss_before_mb': round(self.before / 1e6, 1), 'peak_rss_delta_mb': round((self.peak - self.before) / 1e6, 1),
+                'rss_delta_mb': round((self.after - self.before) / 1e6, 1)}
+
+def time_stage(results: list, stage: str, func, stage_bscans: int, stage_bytes: int, **extra) -> None:
+    """Runs one benchmark stage and appends its wall time, throughput and the memory it took to the results."""
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        func()
+        seconds = time.perf_counter() - start
+    result = {'stage': stage, 'seconds': round(seconds, 6),
+              'mb_per_s': round(stage_bytes / 1e6 / seconds, 3) if seconds > 0 else None,
+              'bscans_per_s': round(stage_bscans / seconds, 3) if seconds > 0 else None}
+    result.update(sampler.memory())
+    result.update(extra)
+    results.append(result)
+    print(f"{extra.get('data_format', '')} {extra.get('size', '')} {stage}: {seconds:.3f} s, {result['mb_per_s']} MB/s, {result['bscans_per_s']} B-scans/s, +{result['peak_rss_delta_mb']} MB peak")
+
+def benchmark_volume(filepath: str, data_format: str, width: int, height: int, num_bscans: int, batch_size: int, registration_images: int, output_folder: str, size_name: str) -> list[dict]:
+    """Times every stage of the converter separately on one synthetic volume."""
+    results = []
+    normalize_func = normalize_image_complex64 if data_format == 'complex64' else normalize_image_float32
+    bytes_per_value = 8 if data_format == 'complex64' else 4
+    file_bytes = bytes_per_value * width * height * num_bscans
+    bscan_bytes = 4 * width * height
+    extra = {'data_format': data_format, 'size': size_name, 'width': width, 'height': height, 'n_bscans': num_bscans, 'batch_size': batch_size}
+
+    # Reading (the volume was just written, so it is usually served from the page cache)
+    def read(reader):
+        for bscan_batch in reader(filepath, data_format, width, height, num_bscans, batch_size, normalize_func, False):
+            if isinstance(bscan_batch, np.ndarray):
+                np.ascontiguousarray(bscan_batch) # Make sure memory-mapped batches are actually read
+    time_stage(results, 'read', lambda: read(read_large_file_in_batches), num_bscans, file_bytes, **extra)
+    time_stage(results, 'read_memmap', lambda: read(read_large_file_in_batches_memmap), num_bscans, file_bytes, **extra)
+
+    # Keep one batch in memory for the processing stages
+    bscan_batch = np.array(next(read_large_file_in_batches_memmap(filepath, data_format, width, height, num_bscans, batch_size, normalize_func, False)))
+    n_batch = len(bscan_batch)
+    batch_bytes = bscan_bytes * n_batch
+
+    n_register = min(registration_images, n_batch)
+    time_stage(results, 'register', lambda: register_images(bscan_batch[0], bscan_batch[:n_register]), n_register, bscan_bytes * n_register, **extra)
+
+    averaged = {}
+    def average():
+        averaged['bscan'] = np.mean(bscan_batch, axis=0)
+    time_stage(results, 'average', average, n_batch, batch_bytes, **extra)
+    time_stage(results, 'average_streaming', lambda: average_bscans_streaming(iter(bscan_batch), False), n_batch, batch_bytes, **extra)
+
+    def normalize():
+        averaged['bscan'] = normalize_func(averaged['bscan']).astype(np.uint8)
+    time_stage(results, 'normalize', normalize, 1, bscan_bytes, **extra)
+
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    time_stage(results, 'clahe', lambda: clahe.apply(averaged['bscan']), 1, width * height, **extra)
+
+    save_path = os.path.join(output_folder, f"bscan_{data_format}_{size_name}.png")
+    time_stage(results, 'save', lambda: save_bscan_image(averaged['bscan'], save_path), 1, width * height, **extra)
+    return results
+
+def get_git_commit() -> str | None:
+    """Returns the current git commit of the repository, if available."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the HoloOCT raw volume converter on synthetic data.')
+    parser.add_argument('--config', default='config.yaml', help='Config file providing the default geometry and averaging')
+    parser.add_argument('--formats', nargs='+', default=['float32', 'complex64'], choices=['float32', 'complex64'])
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=['small', 'config', 'large'], help='Volume sizes to benchmark (config and large write multi-GB temporary files)')
+    parser.add_argument('--n-bscans', type=int, default=512, help='B-scans per synthetic volume')
+    parser.add_argument('--registration-images', type=int, default=16, help='Images registered in the registration stage')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file with the results')
+    parser.add_argument('--work-dir', default=None, help='Folder for the synthetic volumes (temporary by default)')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    width, height = config['image_size']
+    batch_size = config['post_processing_average_per_n_slices']
+    geometries = {'small': (width // 4, height // 4), 'config': (width, height), 'large': (width * 2, height * 2)}
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        for data_format in args.formats:
+            for size_name in args.sizes:
+                size_width, size_height = geometries[size_name]
+                filepath = os.path.join(work_dir, f"synthetic_{data_format}_{size_name}.raw")
+                file_bytes = (8 if data_format == 'complex64' else 4) * size_width * size_height * args.n_bscans
+                print(f"Writing a {file_bytes / 1e9:.2f} GB synthetic volume - {filepath}")
+                generate_synthetic_volume(filepath, data_format, size_width, size_height, args.n_bscans)
+                results.extend(benchmark_volume(filepath, data_format, size_width, size_height, args.n_bscans, batch_size, args.registration_images, work_dir, size_name))
+                os.remove(filepath)
+
+    report = {
+        'meta': {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'git_commit': get_git_commit(),
+                 'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+                 'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'results': results,
+    }
+    with open(args.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results saved - {args.output}")
+
+
+if __name__ == "__main__":
+    main()
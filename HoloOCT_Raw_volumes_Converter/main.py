@@ -1,14 +1,29 @@
 # System and basic packages
 import sys
 import os
-import struct
 import yaml
+import argparse
 import re
+import io
+import csv
+import json
+import time
+import hashlib
+import threading
+import queue
+import contextlib
+import functools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
 
 # Array and image manipulation packages
 import numpy as np
 import matplotlib.pyplot as plt
-from PIL import Image
+from PIL import Image, TiffImagePlugin
 import cv2
 
 
@@ -31,14 +46,20 @@ def print_loading_bar(counter: int, total: int, previous_message: str = 'Process
     sys.stdout.write(f"\r{previous_message}: [{bar}] {counter}/{total} ({int(progress * 100)}%)")
     sys.stdout.flush()
 
-def count_total_elements(data: int | list | dict) -> int:
-    """Counts the total number of elements in a nested structure."""
-    if isinstance(data, dict):
-        return sum(count_total_elements(value) for value in data.values())
-    elif isinstance(data, list):
-        return sum(count_total_elements(item) for item in data)
-    else:
-        return 1
+def get_peak_rss_bytes() -> int | None:
+    """Returns the peak resident memory of the process in bytes, or None if it can't be measured."""
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024 # Linux reports kilobytes
+
+def get_current_rss_bytes() -> int | None:
+    """Returns the current resident memory of the process in bytes (the peak where it can't be sampled)."""
+    try:
+        with open('/proc/self/statm', 'r') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return get_peak_rss_bytes()
 
 def load_config(config_path: str) -> dict:
     """Loads configuration from a YAML file."""
@@ -48,6 +69,116 @@ def load_config(config_path: str) -> dict:
 
 
 
+# Profiling
+class PipelineProfiler:
+    """
+    Records the wall time and bytes of each pipeline stage for every batch, and samples the process RSS.
+
+    Stages can be nested (e.g. reading inside a streaming average): each stage only counts its
+    own time, without the time of the stages it contains.
+
+    Methods:
+        - stage(): Context manager timing one stage of the current batch.
+        - start_batch() / end_batch(): Delimit the batch the stages belong to.
+        - add_batch(): Adds a batch record measured elsewhere (e.g. in a pool worker).
+        - collect() / merge(): Record the stages of another thread apart, then add them to the current batch.
+        - save(): Writes the per-batch trace CSV and the summary JSON.
+    """
+    stages = ('read', 'magnitude', 'registration', 'mean', 'normalize', 'clahe', 'encode', 'write')
+
+    def __init__(self):
+        self.batches = []
+        self.current = None
+        self.start_time = time.perf_counter()
+        self._local = threading.local()
+
+    def start_batch(self, file_idx: int, batch_idx: int) -> None:
+        self.current = {'file_idx': file_idx, 'batch_idx': batch_idx, 'seconds': dict.fromkeys(self.stages, 0.0), 'bytes': dict.fromkeys(self.stages, 0)}
+
+    @contextlib.contextmanager
+    def stage(self, name: str, n_bytes: int = 0):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            record = self._local.__dict__.get('record') or self.current
+            if record is not None:
+                record['seconds'][name] = record['seconds'].get(name, 0.0) + elapsed - nested
+                record['bytes'][name] = record['bytes'].get(name, 0) + n_bytes
+
+    @contextlib.contextmanager
+    def collect(self):
+        """Records the stages of the calling thread in a record of their own, e.g. for a batch read ahead."""
+        self._local.record = {'seconds': {}, 'bytes': {}}
+        try:
+            yield self._local.record
+        finally:
+            self._local.record = None
+
+    def merge(self, record: dict) -> None:
+        if self.current is None:
+            return
+        for name, seconds in record['seconds'].items():
+            self.current['seconds'][name] = self.current['seconds'].get(name, 0.0) + seconds
+            self.current['bytes'][name] = self.current['bytes'].get(name, 0) + record['bytes'][name]
+
+    def end_batch(self) -> dict:
+        record = self.current
+        rss = get_current_rss_bytes()
+        record['pid'] = os.getpid()
+        record['rss_mb'] = round(rss / 1e6, 1) if rss is not None else None
+        self.batches.append(record)
+        self.current = None
+        return record
+
+    def add_batch(self, record: dict) -> None:
+        self.batches.append(record)
+
+    def summary(self) -> dict:
+        """Totals per stage, their share of the measured time and the dominant stage."""
+        stage_names = list(dict.fromkeys(name for record in self.batches for name in record['seconds']))
+        totals = {name: sum(record['seconds'].get(name, 0.0) for record in self.batches) for name in stage_names}
+        measured = sum(totals.values())
+        stages = {}
+        for name in stage_names:
+            n_bytes = sum(record['bytes'].get(name, 0) for record in self.batches)
+            stages[name] = {'seconds': round(totals[name], 6), 'bytes': n_bytes,
+                            'mb_per_s': round(n_bytes / 1e6 / totals[name], 3) if totals[name] > 0 and n_bytes else None,
+                            'share': round(totals[name] / measured, 4) if measured > 0 else None}
+        rss_values = [record['rss_mb'] for record in self.batches if record.get('rss_mb') is not None]
+        peak_rss = get_peak_rss_bytes()
+        io_seconds = totals.get('read', 0.0) + totals.get('write', 0.0)
+        return {'wall_seconds': round(time.perf_counter() - self.start_time, 3), 'batches': len(self.batches),
+                'stages': stages, 'bottleneck': max(totals, key=totals.get) if totals else None,
+                'io_share': round(io_seconds / measured, 4) if measured > 0 else None,
+                'max_sampled_rss_mb': max(rss_values) if rss_values else None,
+                'peak_rss_mb': round(peak_rss / 1e6, 1) if peak_rss is not None else None}
+
+    def save(self, save_folder: str, prefix: str = 'profile') -> None:
+        os.makedirs(save_folder, exist_ok=True)
+        stage_names = list(dict.fromkeys(name for record in self.batches for name in record['seconds']))
+        with open(os.path.join(save_folder, f"{prefix}_trace.csv"), 'w', newline='') as trace_file:
+            writer = csv.writer(trace_file)
+            writer.writerow(['file_idx', 'batch_idx', 'pid', 'rss_mb'] + [f"{name}_s" for name in stage_names] + [f"{name}_bytes" for name in stage_names])
+            for record in self.batches:
+                writer.writerow([record['file_idx'], record['batch_idx'], record['pid'], record['rss_mb']]
+                                + [f"{record['seconds'].get(name, 0.0):.6f}" for name in stage_names] + [record['bytes'].get(name, 0) for name in stage_names])
+        with open(os.path.join(save_folder, f"{prefix}_summary.json"), 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+def profile_stage(profiler: PipelineProfiler | None, name: str, n_bytes: int = 0):
+    """Times a stage with the profiler, or does nothing when profiling is disabled."""
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(name, n_bytes)
+
+
 # Processing Functions
 def normalize_image_float32(image: np.ndarray) -> np.ndarray:
     """Normalizes a float32 image to the range [0, 255]."""
@@ -60,16 +191,96 @@ def normalize_image_complex64(image: np.ndarray) -> np.ndarray:
     image = (255 * (image / np.max(image)))
     return image
 
-def calculate_average_slices(images: list[np.ndarray], n_slices_average: int) -> list[np.ndarray]:
-    """Calculates the average of images in groups of n_slices_average."""
+def normalize_image_to_bounds(image: np.ndarray, lower_bound: float, upper_bound: float) -> np.ndarray:
+    """Normalizes an image to the range [0, 255] between fixed bounds (e.g. shared by a whole volume)."""
+    image = (image - lower_bound) * (255 / max(upper_bound - lower_bound, np.finfo(np.float32).eps))
+    return np.clip(image, 0, 255)
+
+def calculate_average_slices(images: np.ndarray, n_slices_average: int) -> np.ndarray:
+    """Calculates the average of a (n, height, width) stack of images in groups of n_slices_average."""
+    images = np.asarray(images)
     assert len(images) % n_slices_average == 0, f"Error: Number of images ({len(images)}) is not divisible by n_slices_average ({n_slices_average})."
     n_groups = len(images) // n_slices_average
-    return [np.mean(images[i * n_slices_average:(i + 1) * n_slices_average], axis=0) for i in range(n_groups)]
+    return images.reshape((n_groups, n_slices_average) + images.shape[1:]).mean(axis=1)
+
+class StreamingHistogram:
+    """
+    Fixed-bin histogram of values seen batch by batch, to get percentiles without keeping or sorting the values.
+
+    The range starts at the first values and doubles (merging pairs of bins) whenever new values
+    fall outside of it, so percentiles stay within about two bins of range / n_bins.
+
+    Methods:
+        - add(): Counts the (optionally weighted) values of an array.
+        - merge(): Adds the counts of another histogram (e.g. computed in a pool worker).
+        - percentiles(): Values below which the given percentages of the counts fall.
+    """
+    def __init__(self, n_bins: int = 16384):
+        assert n_bins % 2 == 0, f"Error: n_bins ({n_bins}) must be even."
+        self.n_bins = n_bins
+        self.counts = np.zeros(n_bins, dtype=np.float64)
+        self.lower = None
+        self.bin_width = None
+
+    def _extend(self, min_value: float, max_value: float) -> None:
+        if self.lower is None:
+            self.lower = min_value
+            self.bin_width = max(max_value - min_value, abs(min_value) * 1e-6, 1e-12) / self.n_bins
+        while min_value < self.lower or max_value > self.lower + self.bin_width * self.n_bins:
+            merged_counts = self.counts.reshape(-1, 2).sum(axis=1)
+            self.counts = np.zeros_like(self.counts)
+            if min_value < self.lower: # Grow downwards, the current range becomes the upper half
+                self.counts[self.n_bins // 2:] = merged_counts
+                self.lower -= self.bin_width * self.n_bins
+            else:
+                self.counts[:self.n_bins // 2] = merged_counts
+            self.bin_width *= 2
+
+    def add(self, values: np.ndarray, weights: np.ndarray | None = None) -> None:
+        values = np.ravel(values)
+        weights = np.ravel(weights) if weights is not None else None
+        min_value, max_value = float(values.min(initial=np.inf)), float(values.max(initial=-np.inf))
+        if not (np.isfinite(min_value) and np.isfinite(max_value)): # Empty or with NaN/inf values
+            finite = np.isfinite(values)
+            values, weights = values[finite], (weights[finite] if weights is not None else None)
+            if len(values) == 0:
+                return
+            min_value, max_value = float(values.min()), float(values.max())
+        self._extend(min_value, max_value)
+        bin_indices = np.clip(((values - self.lower) / self.bin_width).astype(np.int64), 0, self.n_bins - 1)
+        self.counts += np.bincount(bin_indices, weights, minlength=self.n_bins)
+
+    def merge(self, other: 'StreamingHistogram') -> None:
+        if other.lower is None:
+            return
+        used = other.counts > 0
+        bin_centers = other.lower + (np.arange(other.n_bins)[used] + 0.5) * other.bin_width
+        self.add(bin_centers, other.counts[used])
+
+    def percentiles(self, percentages) -> np.ndarray:
+        assert self.lower is not None, "Error: The histogram has no values."
+        return get_percentiles_from_counts(self.counts, self.lower, self.bin_width, percentages)
+
+def get_percentiles_from_counts(counts: np.ndarray, lower: float, bin_width: float, percentages) -> np.ndarray:
+    """Interpolates percentiles from histogram counts of bins of bin_width starting at lower."""
+    cumulative_counts = np.cumsum(counts)
+    targets = np.asarray(percentages, dtype=np.float64) / 100 * cumulative_counts[-1]
+    bin_indices = np.clip(np.searchsorted(cumulative_counts, np.maximum(targets, 1e-12)), 0, len(counts) - 1) # First non-empty bin for 0
+    previous_counts = np.where(bin_indices > 0, cumulative_counts[bin_indices - 1], 0)
+    fractions = np.clip((targets - previous_counts) / np.maximum(counts[bin_indices], 1e-12), 0, 1)
+    return lower + (bin_indices + fractions) * bin_width
+
+def get_histogram_percentiles(image: np.ndarray, percentages, n_bins: int = 16384) -> np.ndarray:
+    """Percentiles of an image from its histogram (one counting pass instead of a partition per percentile)."""
+    if image.dtype == np.uint8:
+        return get_percentiles_from_counts(np.bincount(image.ravel(), minlength=256), -0.5, 1, percentages) # Bins centered on the levels
+    histogram = StreamingHistogram(n_bins)
+    histogram.add(image)
+    return histogram.percentiles(percentages)
 
 def linear_histogram_stretching(image, lower_percentile=1, upper_percentile=99):
     """Aply lineal stretching using percentils to improve the image contrast"""
-    lower_bound = np.percentile(image, lower_percentile)
-    upper_bound = np.percentile(image, upper_percentile)
+    lower_bound, upper_bound = get_histogram_percentiles(image, (lower_percentile, upper_percentile))
     
     # Clip and scale the image
     stretched_image = np.clip((image - lower_bound) / (upper_bound - lower_bound), 0, 1)
@@ -77,6 +288,116 @@ def linear_histogram_stretching(image, lower_percentile=1, upper_percentile=99):
     
     return stretched_image
 
+def build_image_pyramid(image: np.ndarray, pyramid_levels: int) -> list[np.ndarray]:
+    """Builds a float32 Gaussian pyramid, from full resolution to the coarsest level."""
+    pyramid = [np.ascontiguousarray(image, dtype=np.float32)]
+    for _ in range(pyramid_levels - 1):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+def get_registration_criteria(number_of_iterations: int = 500, termination_eps: float = 1e-6, check_convergence: bool = False) -> tuple:
+    """Builds the ECC termination criteria applied at every pyramid level, plus whether to check the convergence of each registration."""
+    return (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps, check_convergence)
+
+def register_image(reference_pyramid: list[np.ndarray], image: np.ndarray, warp_matrix: np.ndarray, criteria: tuple | None = None) -> tuple[np.ndarray, np.ndarray, dict]:
+    """Registers one image with respect to a reference pyramid using coarse-to-fine ECC.
+
+    The warp found at each level seeds the next finer one, so full resolution only has to refine it.
+
+    Args:
+        reference_pyramid (List[np.ndarray]): Reference image pyramid built with build_image_pyramid.
+        image (np.ndarray): Image to register.
+        warp_matrix (np.ndarray): Initial 2x3 warp matrix at full resolution.
+        criteria (tuple, optional): ECC termination criteria, get_registration_criteria() by default.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, dict]: Registered image, converged warp matrix (the initial one if
+        registration fails) and the ECC correlation coefficient and convergence of the registration
+        (False if the iteration budget ran out before the correlation changed less than eps, None
+        unless the criteria ask to check it, since that costs one more ECC iteration).
+    """
+    sz = reference_pyramid[0].shape
+    warp_mode = cv2.MOTION_AFFINE # You can try cv2.MOTION_TRANSLATION, cv2.MOTION_EUCLIDEAN or cv2.MOTION_AFFINE
+
+    # Termination criteria
+    if criteria is None:
+        criteria = get_registration_criteria()
+    check_convergence = len(criteria) > 3 and criteria[3]
+    criteria = criteria[:3]
+
+    # Convert image to float32 if necessary
+    pyramid_levels = len(reference_pyramid)
+    image_pyramid = build_image_pyramid(image, pyramid_levels)
+    im2_gray = image_pyramid[0]
+
+    # Perform the ECC algorithm from the coarsest to the full resolution level
+    level_warp = warp_matrix.copy()
+    level_warp[:, 2] /= 2 ** (pyramid_levels - 1)
+    for level in reversed(range(pyramid_levels)):
+        try:
+            ecc, level_warp = cv2.findTransformECC(reference_pyramid[level], image_pyramid[level], level_warp, warp_mode, criteria)
+        except cv2.error as e:
+            if level == 0:
+                print(f"Error during image registration: {e}")
+                # If registration fails, return the original image
+                return im2_gray, warp_matrix, {'ecc': float('nan'), 'converged': False}
+        if level > 0:
+            level_warp[:, 2] *= 2
+
+    # OpenCV does not report the iterations used, so one more iteration from the final warp
+    # tells whether the correlation had stopped changing (converged) or the budget ran out
+    converged = None
+    if check_convergence:
+        try:
+            next_ecc, _ = cv2.findTransformECC(reference_pyramid[0], im2_gray, level_warp.copy(), warp_mode, (cv2.TERM_CRITERIA_COUNT, 1, 0))
+            converged = bool(abs(next_ecc - ecc) < criteria[2])
+        except cv2.error:
+            converged = False
+
+    # Apply the warp transformation to the image
+    im2_aligned = cv2.warpAffine(im2_gray, level_warp, (sz[1], sz[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+    return im2_aligned, level_warp, {'ecc': float(ecc), 'converged': converged}
+
+def register_images_with_details(reference_image: np.ndarray, image_list: list[np.ndarray], workers: int = 1, pyramid_levels: int = 1, initial_warps: list[np.ndarray] | None = None, criteria: tuple | None = None):
+    """Registers a list of images with respect to a reference image, optionally in parallel.
+
+    Sequentially, each image starts from the warp of the previous one. With several workers
+    the images are registered concurrently in a thread pool (OpenCV releases the GIL), each
+    one starting from its warp in initial_warps, e.g. the warps of the previous batch.
+
+    Args:
+        reference_image (np.ndarray): The reference image.
+        image_list (List[np.ndarray]): List of images to register.
+        workers (int): Number of registration threads.
+        pyramid_levels (int): Number of pyramid levels of the coarse-to-fine registration.
+        initial_warps (List[np.ndarray], optional): Initial warp matrix for each image.
+        criteria (tuple, optional): ECC termination criteria, get_registration_criteria() by default.
+
+    Returns:
+        Tuple[List[np.ndarray], List[np.ndarray], List[dict]]: Registered images (the reference first),
+        the converged warp matrix and the registration details of each image.
+    """
+    reference_pyramid = build_image_pyramid(reference_image, pyramid_levels)
+    if initial_warps is None or len(initial_warps) != len(image_list):
+        initial_warps = None
+
+    if workers > 1:
+        identity = np.eye(2, 3, dtype=np.float32)
+        warps = initial_warps if initial_warps is not None else [identity] * len(image_list)
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(lambda args: register_image(reference_pyramid, *args, criteria), zip(image_list, warps)))
+    else:
+        results = []
+        warp_matrix = np.eye(2, 3, dtype=np.float32)
+        for idx, image in enumerate(image_list):
+            if initial_warps is not None:
+                warp_matrix = initial_warps[idx]
+            results.append(register_image(reference_pyramid, image, warp_matrix, criteria))
+            warp_matrix = results[-1][1]
+
+    registered_images = [reference_pyramid[0]] + [result[0] for result in results]
+    return registered_images, [result[1] for result in results], [result[2] for result in results]
+
 def register_images(reference_image: np.ndarray, image_list: list[np.ndarray]):
     """Registers a list of images with respect to a reference image using the ECC algorithm.
 
@@ -87,204 +408,1597 @@ def register_images(reference_image: np.ndarray, image_list: list[np.ndarray]):
     Returns:
         List[np.ndarray]: List of registered images.
     """
-    registered_images = []
-    sz = reference_image.shape
-    warp_mode = cv2.MOTION_AFFINE # You can try cv2.MOTION_TRANSLATION, cv2.MOTION_EUCLIDEAN or cv2.MOTION_AFFINE
+    registered_images, _, _ = register_images_with_details(reference_image, image_list)
+    return registered_images
 
-    # Define the initial warp matrix
-    warp_matrix = np.eye(2, 3, dtype=np.float32)
+PHASE_CORRELATION_CHUNK = 16 # Images whose translations are estimated in one vectorized FFT
 
-    # Termination criteria
-    number_of_iterations = 500
-    termination_eps = 1e-6
-    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, number_of_iterations, termination_eps)
-
-    # Convert reference image to float32 and register
-    im1_gray = reference_image.astype(np.float32)
-    registered_images.append(im1_gray)
-    for image in image_list:
-        # Convert images to float32 if necessary
-        im2_gray = image.astype(np.float32)
-
-        # Perform the ECC algorithm
-        try:
-            _, warp_matrix = cv2.findTransformECC(im1_gray, im2_gray, warp_matrix, warp_mode, criteria)
-            # Apply the warp transformation to the image
-            im2_aligned = cv2.warpAffine(im2_gray, warp_matrix, (sz[1], sz[0]), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP)
+def prepare_phase_correlation_reference(reference_image: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Computes the Hann window and the windowed spectrum of the reference image for phase correlation."""
+    height, width = reference_image.shape
+    window = np.outer(np.hanning(height), np.hanning(width)).astype(np.float32)
+    reference_image = np.asarray(reference_image, dtype=np.float32)
+    reference_spectrum = np.fft.rfft2((reference_image - reference_image.mean()) * window)
+    return window, reference_spectrum
+
+def estimate_translations(reference_spectrum: np.ndarray, window: np.ndarray, images) -> tuple[np.ndarray, np.ndarray]:
+    """Estimates the translation of a stack of images with respect to the reference by phase correlation.
+
+    All images are transformed with one vectorized FFT, and the correlation peak is refined to
+    sub-pixel precision with the centroid of its 5x5 neighbourhood.
+
+    Args:
+        reference_spectrum (np.ndarray): Reference spectrum from prepare_phase_correlation_reference.
+        window (np.ndarray): Hann window from prepare_phase_correlation_reference.
+        images (np.ndarray): (n, height, width) stack or list of images.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: (n, 2) array of (dx, dy) shifts and the (n,) correlation peak
+        heights (summed over the neighbourhood), close to 0 when uncorrelated and 1 for a pure translation.
+    """
+    images = np.asarray(images, dtype=np.float32)
+    n_images, height, width = images.shape
+    windowed = (images - images.mean(axis=(1, 2), keepdims=True)) * window
+
+    # Normalized cross-power spectrum and correlation surface of every image
+    cross_power = np.fft.rfft2(windowed, axes=(1, 2)) * np.conj(reference_spectrum)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = np.fft.irfft2(cross_power, s=(height, width), axes=(1, 2))
+
+    # Integer peak and centroid sub-pixel refinement (the surface wraps around)
+    idx = np.arange(n_images)[:, np.newaxis, np.newaxis]
+    peak_y, peak_x = np.unravel_index(correlation.reshape(n_images, -1).argmax(axis=1), (height, width))
+    offsets = np.arange(-2, 3)
+    neighbourhood = correlation[idx, (peak_y[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis]) % height, (peak_x[:, np.newaxis, np.newaxis] + offsets) % width]
+    peaks = neighbourhood.sum(axis=(1, 2))
+    weights = np.clip(neighbourhood, 0, None)
+    total_weight = np.maximum(weights.sum(axis=(1, 2)), 1e-12)
+    dy = peak_y + (weights * offsets[:, np.newaxis]).sum(axis=(1, 2)) / total_weight
+    dx = peak_x + (weights * offsets).sum(axis=(1, 2)) / total_weight
+    dy = np.where(dy > height / 2, dy - height, dy)
+    dx = np.where(dx > width / 2, dx - width, dx)
+    return np.stack([dx, dy], axis=1), peaks
+
+def apply_translations(reference_pyramid: list[np.ndarray], images, shifts: np.ndarray, peaks: np.ndarray, min_peak: float, criteria: tuple | None = None):
+    """Warps each image by its estimated translation, falling back to ECC when the correlation peak is weak.
+
+    The fallback ECC starts from the estimated translation, so it only has to refine it.
+
+    Returns:
+        Tuple[List[np.ndarray], List[np.ndarray], List[dict]]: Registered images, warp matrices and
+        registration details of each image.
+    """
+    height, width = reference_pyramid[0].shape
+    registered_images, warps, details = [], [], []
+    for image, (dx, dy), peak in zip(images, shifts, peaks):
+        warp_matrix = np.array([[1, 0, dx], [0, 1, dy]], dtype=np.float32)
+        if peak >= min_peak:
+            im2_gray = np.ascontiguousarray(image, dtype=np.float32)
+            registered_images.append(cv2.warpAffine(im2_gray, warp_matrix, (width, height), flags=cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP))
+            image_details = {'method': 'phase_correlation', 'ecc': float('nan'), 'converged': True}
+        else:
+            im2_aligned, warp_matrix, image_details = register_image(reference_pyramid, image, warp_matrix, criteria)
             registered_images.append(im2_aligned)
-        except cv2.error as e:
-            print(f"Error during image registration: {e}")
-            # If registration fails, add the original image
-            registered_images.append(im2_gray)
+            image_details = dict(image_details, method='ecc')
+        image_details['peak'] = float(peak)
+        warps.append(warp_matrix)
+        details.append(image_details)
+    return registered_images, warps, details
 
-    return registered_images
+def register_images_phase_correlation(reference_image: np.ndarray, image_list: list[np.ndarray], min_peak: float = 0.1, pyramid_levels: int = 1, criteria: tuple | None = None, chunk_size: int = PHASE_CORRELATION_CHUNK):
+    """Registers a list of images with respect to a reference image by FFT phase correlation.
+
+    Translations are estimated with one vectorized FFT per chunk of images and applied with a
+    single warp per image. Images with a correlation peak below min_peak are registered with ECC.
+
+    Args:
+        reference_image (np.ndarray): The reference image.
+        image_list (List[np.ndarray]): List of images to register.
+        min_peak (float): Minimum correlation peak height to trust the phase correlation shift.
+        pyramid_levels (int): Number of pyramid levels of the fallback ECC registration.
+        criteria (tuple, optional): ECC termination criteria, get_registration_criteria() by default.
+        chunk_size (int): Number of images transformed at once, which bounds the FFT memory.
+
+    Returns:
+        Tuple[List[np.ndarray], List[np.ndarray], List[dict]]: Registered images (the reference first),
+        the warp matrix and the registration details of each image.
+    """
+    reference_pyramid = build_image_pyramid(reference_image, pyramid_levels)
+    window, reference_spectrum = prepare_phase_correlation_reference(reference_pyramid[0])
+
+    registered_images, warps, details = [reference_pyramid[0]], [], []
+    for start in range(0, len(image_list), chunk_size):
+        chunk = image_list[start:start + chunk_size]
+        shifts, peaks = estimate_translations(reference_spectrum, window, chunk)
+        chunk_images, chunk_warps, chunk_details = apply_translations(reference_pyramid, chunk, shifts, peaks, min_peak, criteria)
+        registered_images.extend(chunk_images)
+        warps.extend(chunk_warps)
+        details.extend(chunk_details)
+    return registered_images, warps, details
+
+class AngiographyAccumulator:
+    """
+    Computes an OCTA image from the repeated (registered) B-scans of a batch as they are averaged, with running moments.
+
+    'variance' is the speckle variance of the intensities over the B-scans, from Welford's running
+    mean and sum of squared deviations. 'decorrelation' is the mean decorrelation 1 - 2AB / (A² + B²)
+    of consecutive B-scans, in [0, 1]. Only a few float32 images are kept whatever the number of B-scans.
+
+    Methods:
+        - reset(): Starts a new batch, reusing the buffers.
+        - add(): Folds one B-scan into the moments.
+        - result(): Returns the float32 OCTA image of the batch.
+    """
+    methods = ('decorrelation', 'variance')
+
+    def __init__(self, method: str = 'decorrelation'):
+        assert method in self.methods, f"Error: Unknown angiography method ({method}), options are 'decorrelation' and 'variance'."
+        self.method = method
+        self.count = 0
+        self.buffers = None
+
+    def reset(self) -> None:
+        self.count = 0
+
+    def add(self, image: np.ndarray) -> None:
+        if self.buffers is None or self.buffers[0].shape != image.shape:
+            self.buffers = [np.empty(image.shape, dtype=np.float32) for _ in range(5)]
+        moment, accumulated, delta, scratch, squared = self.buffers
+        if self.count == 0:
+            np.copyto(moment, image) # Running mean (variance) or previous B-scan (decorrelation)
+            accumulated.fill(0)
+        elif self.method == 'variance':
+            np.subtract(image, moment, out=delta)
+            np.multiply(delta, 1 / (self.count + 1), out=scratch)
+            moment += scratch
+            np.subtract(image, moment, out=scratch)
+            scratch *= delta
+            accumulated += scratch
+        else:
+            np.multiply(moment, image, out=delta)
+            delta *= 2
+            np.square(moment, out=scratch)
+            np.square(image, out=squared)
+            scratch += squared
+            scratch += np.finfo(np.float32).tiny # Zero where both B-scans are zero
+            np.divide(delta, scratch, out=delta)
+            accumulated += 1
+            accumulated -= delta
+            np.copyto(moment, image)
+        self.count += 1
+
+    def result(self) -> np.ndarray:
+        accumulated = self.buffers[1]
+        if self.method == 'variance':
+            return accumulated / max(self.count, 1)
+        return accumulated / max(self.count - 1, 1)
+
+def get_registration_chunk(post_processing_dic: dict) -> int:
+    """Returns how many B-scans average_bscans_streaming gathers to register them together."""
+    if post_processing_dic.get('registration_mode', 'ecc') == 'ecc':
+        return max(post_processing_dic.get('registration_workers', 1), 1)
+    return PHASE_CORRELATION_CHUNK
+
+def average_bscans_streaming(bscans, register: bool, pyramid_levels: int = 1, registration_state: dict | None = None, criteria: tuple | None = None, registration_mode: str = 'ecc', min_peak: float = 0.1, profiler: PipelineProfiler | None = None, angiography: AngiographyAccumulator | None = None, registration_workers: int = 1) -> np.ndarray:
+    """Averages B-scans by folding each one into a float32 running sum as it is read.
+
+    Memory stays at one accumulator plus the reference image, whatever the number of
+    B-scans. With registration, the result matches np.mean over register_images output.
+    With several registration_workers, that many B-scans are gathered and registered
+    concurrently (each one from its initial warp, as in register_images_with_details)
+    before they are added. Phase correlation gathers PHASE_CORRELATION_CHUNK B-scans and
+    estimates their translations in one vectorized FFT, as register_images_phase_correlation.
+
+    Args:
+        bscans (Iterable[np.ndarray]): B-scans of the batch, the first one used as reference.
+        register (bool): Register each B-scan against the first one before adding it.
+        pyramid_levels (int): Number of pyramid levels of the coarse-to-fine registration.
+        registration_state (dict, optional): Holds the 'warps' of the previous batch used as
+            starting guesses, and receives the 'warps' and 'details' of this one.
+        criteria (tuple, optional): ECC termination criteria, get_registration_criteria() by default.
+        registration_mode (str): 'ecc' or 'phase_correlation'.
+        min_peak (float): Minimum phase correlation peak height before falling back to ECC.
+        profiler (PipelineProfiler, optional): Times the registration of each B-scan.
+        angiography (AngiographyAccumulator, optional): Receives every (registered) B-scan once.
+        registration_workers (int): Number of ECC registration threads.
+
+    Returns:
+        np.ndarray: The float32 averaged B-scan.
+    """
+    running_sum = None
+    count = 0
+    initial_warps = registration_state.get('warps') if registration_state is not None else None
+    warps, details = [], []
+    warp_matrix = np.eye(2, 3, dtype=np.float32)
+    parallel = register and registration_mode == 'ecc' and registration_workers > 1
+    phase_correlation = register and registration_mode == 'phase_correlation'
+    chunk_size = registration_workers if parallel else PHASE_CORRELATION_CHUNK if phase_correlation else 1
+    executor = ThreadPoolExecutor(registration_workers) if parallel else None
+
+    def add_chunk(chunk: list, first_idx: int) -> None:
+        nonlocal running_sum, count, warp_matrix
+        if phase_correlation:
+            with profile_stage(profiler, 'registration', sum(image.nbytes for image in chunk)):
+                shifts, peaks = estimate_translations(reference_spectrum, window, chunk)
+                chunk_images, chunk_warps, chunk_details = apply_translations(reference_pyramid, chunk, shifts, peaks, min_peak, criteria)
+        elif parallel:
+            identity = np.eye(2, 3, dtype=np.float32)
+            start_warps = [initial_warps[idx] if initial_warps is not None and idx < len(initial_warps) else identity for idx in range(first_idx, first_idx + len(chunk))]
+            with profile_stage(profiler, 'registration', sum(image.nbytes for image in chunk)):
+                results = list(executor.map(lambda args: register_image(reference_pyramid, *args, criteria), zip(chunk, start_warps)))
+            chunk_images, chunk_warps, chunk_details = (list(values) for values in zip(*results))
+        elif register:
+            chunk_images, chunk_warps, chunk_details = [], [], []
+            for idx, image in enumerate(chunk, first_idx):
+                if initial_warps is not None and idx < len(initial_warps):
+                    warp_matrix = initial_warps[idx]
+                with profile_stage(profiler, 'registration', image.nbytes):
+                    image, warp_matrix, image_details = register_image(reference_pyramid, image, warp_matrix, criteria)
+                chunk_images.append(image)
+                chunk_warps.append(warp_matrix)
+                chunk_details.append(image_details)
+        else:
+            chunk_images, chunk_warps, chunk_details = chunk, [], []
+        warps.extend(chunk_warps)
+        details.extend(chunk_details)
+        for image in chunk_images:
+            running_sum += image
+            count += 1
+            if angiography is not None:
+                angiography.add(image)
+
+    # B-scans are registered chunk_size at a time, then folded into the sum
+    try:
+        chunk = []
+        for idx, image in enumerate(bscans):
+            if running_sum is None:
+                reference_pyramid = build_image_pyramid(image, pyramid_levels)
+                if phase_correlation:
+                    window, reference_spectrum = prepare_phase_correlation_reference(reference_pyramid[0])
+                running_sum = np.zeros_like(reference_pyramid[0])
+                if register: # register_images keeps the reference besides its registered copy
+                    running_sum += reference_pyramid[0]
+                    count += 1
+            chunk.append(image)
+            if len(chunk) == chunk_size:
+                add_chunk(chunk, idx + 1 - len(chunk))
+                chunk = []
+        if chunk:
+            add_chunk(chunk, idx + 1 - len(chunk))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if register and registration_state is not None:
+        registration_state['warps'] = warps
+        registration_state['details'] = details
+
+    running_sum /= count
+    return running_sum
+
+def write_registration_report(report_path: str, file_idx: int, batch_idx: int, details: list[dict]) -> None:
+    """Appends the registration details of a batch to a CSV report."""
+    write_header = not os.path.exists(report_path)
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    with open(report_path, 'a', newline='') as report_file:
+        writer = csv.writer(report_file)
+        if write_header:
+            writer.writerow(['file_idx', 'batch_idx', 'image_idx', 'method', 'peak', 'ecc', 'converged'])
+        for image_idx, image_details in enumerate(details):
+            peak = f"{image_details['peak']:.6f}" if 'peak' in image_details else ''
+            writer.writerow([file_idx, batch_idx, image_idx, image_details.get('method', 'ecc'), peak, f"{image_details['ecc']:.6f}", image_details['converged']])
 
 
 # Processing large individual files
-def read_large_file_in_batches(filepath: str, data_format: str, width: int, height: int, num_bscans: int, batch_size: int, normalize_func, normalize_individual: bool):
-    """Reads a large file in batches to avoid memory overload."""
-    bytes_per_value = 8 if 'complex64' in data_format else 4
+class RawLayout:
+    """
+    Describes how the B-scans of a large raw file are stored, so every reader decodes them the same way.
+
+    Attributes:
+        - dtype: Sample type and byte order, from data_format ('float32', 'float64', 'complex64' or 'complex128') and byte_order ('little' or 'big').
+        - header_bytes: Bytes before the first B-scan.
+        - bscan_stride: Bytes from the start of one B-scan to the next (the B-scan size when they are contiguous).
+        - axis_order: 'width_height' when each B-scan is stored as width A-scans of height samples (HoloOCT),
+          'height_width' when it is stored row by row in depth.
+        - depth_range, lateral_range: [start, stop) rows and columns of the output images kept by view(),
+          output_height and output_width being their sizes (the whole B-scan by default).
 
-    # Open file by sections
+    Methods:
+        - view(): Views a buffer starting at a B-scan as a (n, width, height) array cropped to the ranges, without copying.
+        - open(): Maps a whole file as a read-only (num_bscans, width, height) array cropped to the ranges.
+        - skip_bscans(): Moves the first B-scan read forward.
+        - expected_file_size(): Size in bytes of a file holding num_bscans B-scans.
+    """
+    data_formats = {'float32': 'f4', 'float64': 'f8', 'complex64': 'c8', 'complex128': 'c16'}
+    byte_orders = {'little': '<', 'big': '>'}
+    axis_orders = ('width_height', 'height_width')
+
+    def __init__(self, data_format: str, width: int, height: int, byte_order: str = 'little', header_bytes: int = 0, bscan_stride: int | None = None, axis_order: str = 'width_height', depth_range: tuple | None = None, lateral_range: tuple | None = None):
+        assert data_format in self.data_formats, f"Error: Unknown data_format ({data_format}), options are {', '.join(self.data_formats)}."
+        assert byte_order in self.byte_orders, f"Error: Unknown byte_order ({byte_order}), options are 'little' and 'big'."
+        assert axis_order in self.axis_orders, f"Error: Unknown axis_order ({axis_order}), options are 'width_height' and 'height_width'."
+        self.data_format = data_format
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(self.byte_orders[byte_order] + self.data_formats[data_format])
+        self.header_bytes = header_bytes
+        self.bscan_bytes = width * height * self.dtype.itemsize
+        self.bscan_stride = bscan_stride or self.bscan_bytes
+        assert self.bscan_stride >= self.bscan_bytes, f"Error: bscan_stride ({self.bscan_stride}) is smaller than a B-scan ({self.bscan_bytes} bytes)."
+        self.axis_order = axis_order
+        self.depth_range = tuple(depth_range or (0, height))
+        self.lateral_range = tuple(lateral_range or (0, width))
+        assert 0 <= self.depth_range[0] < self.depth_range[1] <= height, f"Error: depth_range ({list(self.depth_range)}) must be within the {height} rows of a B-scan."
+        assert 0 <= self.lateral_range[0] < self.lateral_range[1] <= width, f"Error: lateral_range ({list(self.lateral_range)}) must be within the {width} columns of a B-scan."
+        self.output_height = self.depth_range[1] - self.depth_range[0]
+        self.output_width = self.lateral_range[1] - self.lateral_range[0]
+
+    def span_bytes(self, num_bscans: int) -> int:
+        """Bytes from the start of the first of num_bscans B-scans to the end of the last one."""
+        return (num_bscans - 1) * self.bscan_stride + self.bscan_bytes if num_bscans > 0 else 0
+
+    def expected_file_size(self, num_bscans: int) -> int:
+        return self.header_bytes + self.span_bytes(num_bscans)
+
+    def view(self, buffer, num_bscans: int) -> np.ndarray:
+        stored_shape = (self.width, self.height) if self.axis_order == 'width_height' else (self.height, self.width)
+        itemsize = self.dtype.itemsize
+        bscans = np.ndarray((num_bscans,) + stored_shape, dtype=self.dtype, buffer=buffer, strides=(self.bscan_stride, stored_shape[1] * itemsize, itemsize))
+        bscans = bscans if self.axis_order == 'width_height' else bscans.transpose(0, 2, 1)
+        # Output rows follow the stored height and output columns run backwards along the stored width (see bscans_to_images)
+        return bscans[:, self.width - self.lateral_range[1]:self.width - self.lateral_range[0], self.depth_range[0]:self.depth_range[1]]
+
+    def skip_bscans(self, n_bscans: int) -> None:
+        self.header_bytes += n_bscans * self.bscan_stride
+
+    def open(self, filepath: str, num_bscans: int) -> np.ndarray:
+        raw_bytes = np.memmap(filepath, dtype=np.uint8, mode='r', offset=self.header_bytes, shape=(self.span_bytes(num_bscans),))
+        return self.view(raw_bytes, num_bscans)
+
+def detect_raw_layouts(file_size: int, width: int, height: int, num_bscans: int) -> list[str]:
+    """Lists the contiguous layouts (data format with a header or another B-scan count) that a file size is consistent with."""
+    candidates = []
+    for data_format in RawLayout.data_formats:
+        bscan_bytes = RawLayout(data_format, width, height).bscan_bytes
+        header_bytes = file_size - num_bscans * bscan_bytes
+        if header_bytes == 0:
+            candidates.append(f"data_format '{data_format}'")
+        elif 0 < header_bytes < bscan_bytes:
+            candidates.append(f"data_format '{data_format}' with header_bytes {header_bytes}")
+        elif file_size % bscan_bytes == 0:
+            candidates.append(f"data_format '{data_format}' with n_slices_in_volume {file_size // bscan_bytes}")
+    return candidates
+
+def validate_raw_files(folder: str, files: list[str], layout: RawLayout, num_bscans: int) -> None:
+    """Checks the size of every large file against the configured layout before anything is processed.
+
+    Files may end with the stride padding of their last B-scan. Any other size means a wrong
+    image_size, data_format, header or B-scan count, and the layouts matching the file are reported.
+    """
+    expected_sizes = {layout.expected_file_size(num_bscans), layout.header_bytes + num_bscans * layout.bscan_stride}
+    for filename in files:
+        file_size = os.path.getsize(os.path.join(folder, filename))
+        if file_size in expected_sizes:
+            continue
+        candidates = detect_raw_layouts(file_size, layout.width, layout.height, num_bscans)
+        hint = f" It matches {' or '.join(candidates)}." if candidates else " It matches no data_format with this image_size."
+        assert False, f"Error: {filename} has {file_size} bytes but {num_bscans} {layout.data_format} B-scans of {layout.width}x{layout.height} need {layout.expected_file_size(num_bscans)} bytes.{hint}"
+
+def create_raw_layout(data_format: str, image_size: tuple, raw_layout: dict | None = None, roi: dict | None = None) -> RawLayout:
+    """Creates the layout of the large files from the raw_layout and roi sections of the configuration."""
+    raw_layout = raw_layout or {}
+    roi = roi or {}
+    width, height = image_size
+    return RawLayout(data_format, width, height, raw_layout.get('byte_order', 'little'), raw_layout.get('header_bytes', 0),
+                     raw_layout.get('bscan_stride') or None, raw_layout.get('axis_order', 'width_height'), roi.get('depth_range'), roi.get('lateral_range'))
+
+def read_large_file_in_batches(filepath: str, data_format: str, width: int, height: int, num_bscans: int, batch_size: int, normalize_func, normalize_individual: bool, profiler: PipelineProfiler | None = None, first_bscan: int = 0, layout: RawLayout | None = None):
+    """Reads a large file in batches to avoid memory overload, starting at first_bscan."""
+    layout = layout or RawLayout(data_format, width, height)
+
+    # Open file by sections, reading each batch with a single call
     with open(filepath, 'rb') as file:
-        for bscan_idx in range(0, num_bscans, batch_size):
-            bscans = []
-            for i in range(batch_size):
-                if bscan_idx + i >= num_bscans:
+        for bscan_idx in range(first_bscan, num_bscans, batch_size):
+            n_bscans = min(batch_size, num_bscans - bscan_idx)
+            raw_data = bytearray(layout.span_bytes(n_bscans))
+            with profile_stage(profiler, 'read', len(raw_data)):
+                file.seek(layout.header_bytes + bscan_idx * layout.bscan_stride)
+                file.readinto(raw_data)
+            yield convert_raw_bscans(layout.view(raw_data, n_bscans), normalize_func, normalize_individual, profiler)  # Return the batch of B-scans
+
+def open_raw_volume(filepath: str, data_format: str, width: int, height: int, num_bscans: int, layout: RawLayout | None = None) -> np.ndarray:
+    """Maps a large raw file as a read-only (num_bscans, width, height) array without reading it."""
+    layout = layout or RawLayout(data_format, width, height)
+    return layout.open(filepath, num_bscans)
+
+def bscans_to_images(raw_bscans: np.ndarray) -> np.ndarray:
+    """Converts a (n, width, height) block of raw B-scans into (n, height, width) float32 magnitude images."""
+    if np.iscomplexobj(raw_bscans):
+        raw_bscans = np.abs(raw_bscans)
+    if raw_bscans.dtype != np.float32: # Other precisions and byte orders
+        raw_bscans = raw_bscans.astype(np.float32)
+    return np.rot90(raw_bscans, k=3, axes=(1, 2))
+
+def convert_raw_bscans(raw_bscans: np.ndarray, normalize_func, normalize_individual: bool, profiler: PipelineProfiler | None = None) -> np.ndarray:
+    """Converts a block of raw B-scans into images, normalizing each one if requested."""
+    with profile_stage(profiler, 'magnitude', raw_bscans.size * 4):
+        bscans = bscans_to_images(raw_bscans)
+    if normalize_individual:
+        with profile_stage(profiler, 'normalize', bscans.size * 4):
+            bscans = np.stack([normalize_func(bscan_image) for bscan_image in bscans])
+    return bscans
+
+def read_bscan_block(volume: np.ndarray, start: int, stop: int, normalize_func, normalize_individual: bool, profiler: PipelineProfiler | None = None) -> np.ndarray:
+    """Converts the [start, stop) B-scans of a mapped volume at once into a (n, height, width) array.
+
+    Without profiler the mapped pages are read lazily by the magnitude computation. With it,
+    the block is first copied out of the map so that the read time is measured on its own.
+    """
+    raw_bscans = volume[start:stop]
+    if profiler is not None:
+        with profiler.stage('read', raw_bscans.nbytes):
+            raw_bscans = np.array(raw_bscans)
+    return convert_raw_bscans(raw_bscans, normalize_func, normalize_individual, profiler)
+
+def iter_bscan_images(volume: np.ndarray, start: int, stop: int, normalize_func, normalize_individual: bool, profiler: PipelineProfiler | None = None, read_chunk: int = 1):
+    """Converts the [start, stop) B-scans of a mapped volume read_chunk at a time, yielding them one by one."""
+    for chunk_start in range(start, stop, read_chunk):
+        yield from read_bscan_block(volume, chunk_start, min(chunk_start + read_chunk, stop), normalize_func, normalize_individual, profiler)
+
+def read_large_file_in_batches_memmap(filepath: str, data_format: str, width: int, height: int, num_bscans: int, batch_size: int, normalize_func, normalize_individual: bool, profiler: PipelineProfiler | None = None, first_bscan: int = 0, layout: RawLayout | None = None):
+    """Reads a large file in batches through a memory map, converting each batch at once."""
+    volume = open_raw_volume(filepath, data_format, width, height, num_bscans, layout)
+    for bscan_idx in range(first_bscan, num_bscans, batch_size):
+        yield read_bscan_block(volume, bscan_idx, bscan_idx + batch_size, normalize_func, normalize_individual, profiler)
+
+def read_large_file_in_streamed_batches(filepath: str, data_format: str, width: int, height: int, num_bscans: int, batch_size: int, normalize_func, normalize_individual: bool, profiler: PipelineProfiler | None = None, first_bscan: int = 0, layout: RawLayout | None = None, read_chunk: int = 1):
+    """Reads a large file in batches, each one a generator that yields one B-scan at a time (read read_chunk at a time)."""
+    volume = open_raw_volume(filepath, data_format, width, height, num_bscans, layout)
+    for bscan_idx in range(first_bscan, num_bscans, batch_size):
+        yield iter_bscan_images(volume, bscan_idx, min(bscan_idx + batch_size, num_bscans), normalize_func, normalize_individual, profiler, read_chunk)
+
+def is_memory_mapped(array: np.ndarray) -> bool:
+    """Checks whether an array is a view of a memory-mapped file, whose pages are only read when accessed."""
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+class BatchPrefetcher:
+    """
+    Reads the batches of a reader ahead on a background thread while the current batch is processed.
+
+    Arrays still backed by a memory map are copied on the thread so their pages are read there too.
+    Streamed batches (generators of B-scans) are read ahead B-scan by B-scan. At most depth items
+    wait in the queue, which bounds the memory of the read-ahead.
+
+    Attributes:
+        - stall_seconds: Time the processing waited for a batch or B-scan that was not read yet.
+
+    Methods:
+        - __next__(): Returns the next batch (an array, or a generator of B-scans for streamed batches).
+        - close(): Stops the background thread.
+    """
+    def __init__(self, bscan_batches, depth: int, profiler: PipelineProfiler | None = None):
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.profiler = profiler
+        self.stall_seconds = 0.0
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, args=(bscan_batches,), daemon=True)
+        self.thread.start()
+
+    def _next(self, iterator):
+        """Reads the next item of an iterator on this thread, with the stages it records."""
+        with self.profiler.collect() if self.profiler is not None else contextlib.nullcontext() as record:
+            item = next(iterator, None)
+            if isinstance(item, np.ndarray) and is_memory_mapped(item):
+                with profile_stage(self.profiler, 'read', item.nbytes):
+                    item = np.ascontiguousarray(item)
+        return item, record
+
+    def _put(self, kind: str, item=None, record: dict | None = None) -> bool:
+        while not self.closed.is_set():
+            try:
+                self.queue.put((kind, item, record), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_ahead(self, bscan_batches) -> None:
+        try:
+            while True:
+                bscan_batch, record = self._next(bscan_batches)
+                if bscan_batch is None:
                     break
+                if isinstance(bscan_batch, np.ndarray):
+                    if not self._put('batch', bscan_batch, record):
+                        return
+                    continue
+                while True:
+                    bscan_image, record = self._next(bscan_batch)
+                    if not self._put('image' if bscan_image is not None else 'end', bscan_image, record):
+                        return
+                    if bscan_image is None:
+                        break
+            self._put('done')
+        except BaseException as error:
+            self._put('error', error)
 
-                # Read data
-                raw_data = file.read(bytes_per_value * width * height)
-                if data_format == 'complex64':
-                    float_array = np.frombuffer(raw_data, dtype=np.complex64)
-                    float_array = np.abs(float_array)
-                else:
-                    float_array = np.frombuffer(raw_data, dtype=np.float32)
+    def _get(self):
+        start = time.perf_counter()
+        with profile_stage(self.profiler, 'stall'):
+            kind, item, record = self.queue.get()
+        self.stall_seconds += time.perf_counter() - start
+        if record is not None:
+            self.profiler.merge(record)
+        if kind == 'error':
+            raise item
+        return kind, item
 
-                # Reshape and rotate
-                bscan_image = float_array.reshape((width, height))
-                bscan_image = np.rot90(bscan_image, k=3)
-                if normalize_individual:
-                    bscan_image = normalize_func(bscan_image)
-                bscans.append(bscan_image)
+    def _iter_streamed_batch(self, first_image: np.ndarray):
+        yield first_image
+        while True:
+            kind, bscan_image = self._get()
+            if kind == 'end':
+                return
+            yield bscan_image
 
-            yield bscans  # Return the batch of B-scans
+    def __iter__(self):
+        return self
 
-def process_large_files_in_folder(folder: str, n_slices_in_volume: int, post_processing_average_per_n_slices: int, image_size: tuple, data_format: str, normalize_individual: bool, normalize_postprocessed: bool, normalize_func, post_processing_dic: dict, save_folder: str, save_image: bool):
-    """Processes all large files in the folder containing multiple B-scans."""
-    files = [f for f in os.listdir(folder) if f.endswith('.raw')]
-    total_files = len(files)
-    width, height = image_size
+    def __next__(self):
+        kind, item = self._get()
+        if kind == 'done':
+            raise StopIteration
+        return item if kind == 'batch' else self._iter_streamed_batch(item)
+
+    def close(self) -> None:
+        self.closed.set()
+
+def average_bscan_batch(bscan_batch, post_processing_average_per_n_slices: int, post_processing_dic: dict, streaming_average: bool, registration_state: dict | None = None, profiler: PipelineProfiler | None = None, projections: dict | None = None, angiography: AngiographyAccumulator | None = None) -> np.ndarray:
+    """Averages a batch of B-scans (registering them if requested) into a float B-scan.
+
+    registration_state carries the converged warps from one batch to the next (when
+    registration_warm_start is enabled) and receives the registration details of the batch.
+    projections, if given, receives the 'mean' and 'max' of the averaged B-scan along depth.
+    angiography, if given, is reset and fed the (registered) B-scans of the batch in the same pass.
+    """
+    register = post_processing_average_per_n_slices > 1 and post_processing_dic['register_images_pre_average'] == True
+    pyramid_levels = post_processing_dic.get('registration_pyramid_levels', 1)
+    criteria = get_registration_criteria(post_processing_dic.get('registration_iterations', 500), post_processing_dic.get('registration_eps', 1e-6),
+                                         post_processing_dic.get('registration_report', False))
+    registration_mode = post_processing_dic.get('registration_mode', 'ecc')
+    min_peak = post_processing_dic.get('phase_correlation_min_peak', 0.1)
+    if registration_state is None:
+        registration_state = {}
+    if not post_processing_dic.get('registration_warm_start', False):
+        registration_state.pop('warps', None)
+    if angiography is not None:
+        angiography.reset()
+
+    # Average the batch
+    if streaming_average:
+        with profile_stage(profiler, 'mean'):
+            averaged_bscan = average_bscans_streaming(bscan_batch, register, pyramid_levels, registration_state, criteria, registration_mode, min_peak, profiler, angiography,
+                                                      post_processing_dic.get('registration_workers', 1))
+    elif post_processing_average_per_n_slices > 1:
+        batch_bytes = sum(bscan_image.nbytes for bscan_image in bscan_batch)
+        with profile_stage(profiler, 'registration', batch_bytes if register else 0):
+            if register and registration_mode == 'phase_correlation': # Register images by translation
+                bscan_batch, registration_state['warps'], registration_state['details'] = register_images_phase_correlation(
+                    bscan_batch[0], bscan_batch, min_peak, pyramid_levels, criteria)
+            elif register: # Register images
+                bscan_batch, registration_state['warps'], registration_state['details'] = register_images_with_details(
+                    bscan_batch[0], bscan_batch, post_processing_dic.get('registration_workers', 1), pyramid_levels, registration_state.get('warps'), criteria)
+        with profile_stage(profiler, 'mean', batch_bytes):
+            averaged_bscan = np.mean(bscan_batch, axis=0)
+            if angiography is not None:
+                for bscan_image in (bscan_batch[1:] if register else bscan_batch): # Registered lists start with the reference
+                    angiography.add(bscan_image)
+    else:
+        averaged_bscan = np.array(bscan_batch)[0]
+        if angiography is not None:
+            angiography.add(averaged_bscan)
+
+    # En-face rows from the averaged intensities, before they are normalized
+    if projections is not None:
+        with profile_stage(profiler, 'mean', averaged_bscan.nbytes):
+            projections['mean'] = averaged_bscan.mean(axis=0)
+            projections['max'] = averaged_bscan.max(axis=0)
+    return averaged_bscan
+
+class PostProcessingChain:
+    """
+    Turns averaged B-scans into 8-bit images in place, on buffers reused from one B-scan to the next.
+
+    The stages come from the settings: 'normalize' (if normalize_postprocessed), 'uint8' and
+    'clahe' (if a CLAHE operator is given). The normalizations of this module (min-max, max and
+    fixed bounds) run in place on a float32 buffer with a single min/max pass, other normalize
+    functions are called as they are. The returned image is a buffer of the chain that the next
+    call overwrites, so it must be written out (or copied) before.
+
+    Methods:
+        - __call__(): Runs the stages on an averaged B-scan and returns the 8-bit image.
+    """
+    def __init__(self, normalize_postprocessed: bool, normalize_func, clahe=None):
+        self.stages = (['normalize'] if normalize_postprocessed else []) + ['uint8'] + (['clahe'] if clahe is not None else [])
+        self.normalize_func = normalize_func
+        self.clahe = clahe
+        self.buffers = {}
+        if normalize_func is normalize_image_float32:
+            self.normalization = 'min_max'
+        elif normalize_func is normalize_image_complex64:
+            self.normalization = 'max'
+        elif isinstance(normalize_func, functools.partial) and normalize_func.func is normalize_image_to_bounds:
+            self.normalization = 'bounds'
+        else:
+            self.normalization = 'function'
+
+    def _get_buffer(self, name: str, shape: tuple, dtype) -> np.ndarray:
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = self.buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
+
+    def _normalize(self, image: np.ndarray) -> np.ndarray:
+        if self.normalization == 'function':
+            return self.normalize_func(image)
+        buffer = self._get_buffer('float32', image.shape, np.float32)
+        np.copyto(buffer, image, casting='unsafe')
+        if self.normalization == 'bounds':
+            lower_bound, upper_bound = self.normalize_func.keywords['lower_bound'], self.normalize_func.keywords['upper_bound']
+            np.subtract(buffer, np.float32(lower_bound), out=buffer)
+            np.multiply(buffer, np.float32(255 / max(upper_bound - lower_bound, np.finfo(np.float32).eps)), out=buffer)
+            np.clip(buffer, 0, 255, out=buffer)
+            return buffer
+
+        # Same float32 operations as normalize_image_float32 and normalize_image_complex64, without temporaries
+        min_value, max_value, _, _ = cv2.minMaxLoc(buffer)
+        if self.normalization == 'min_max':
+            np.subtract(buffer, np.float32(min_value), out=buffer)
+            np.divide(buffer, np.float32(max_value) - np.float32(min_value), out=buffer)
+            np.multiply(buffer, 255, out=buffer)
+            np.clip(buffer, 0, 255, out=buffer)
+        else:
+            np.divide(buffer, np.float32(max_value), out=buffer)
+            np.multiply(buffer, 255, out=buffer)
+        return buffer
+
+    def __call__(self, averaged_bscan: np.ndarray, profiler: PipelineProfiler | None = None) -> np.ndarray:
+        # Normalize averaged images
+        with profile_stage(profiler, 'normalize', averaged_bscan.nbytes):
+            if 'normalize' in self.stages:
+                averaged_bscan = self._normalize(averaged_bscan)
+            bscan_image = self._get_buffer('uint8', averaged_bscan.shape, np.uint8)
+            np.copyto(bscan_image, averaged_bscan, casting='unsafe')
+
+        # Postprocess final image if necessary
+        if 'clahe' in self.stages:
+            with profile_stage(profiler, 'clahe', bscan_image.nbytes):
+                bscan_image = self.clahe.apply(bscan_image, self._get_buffer('clahe', bscan_image.shape, np.uint8))
+        return bscan_image
+
+def create_clahe(post_processing_dic: dict):
+    """Creates the CLAHE operator if it is enabled in the post-processing settings."""
     if post_processing_dic['clahe'] == True:
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+        return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+    return None
+
+def save_bscan_image(bscan_image: np.ndarray, save_path: str, profiler: PipelineProfiler | None = None) -> None:
+    """Saves an 8-bit B-scan as an image file, creating its folder if necessary."""
+    with profile_stage(profiler, 'encode', bscan_image.nbytes):
+        encoded_image = io.BytesIO()
+        Image.fromarray(bscan_image).save(encoded_image, format=Image.registered_extensions()[os.path.splitext(save_path)[1].lower()])
+    with profile_stage(profiler, 'write', encoded_image.getbuffer().nbytes):
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        with open(save_path, 'wb') as image_file:
+            image_file.write(encoded_image.getbuffer())
+
+class VolumeOutputWriter:
+    """
+    Writes the processed B-scans of one volume incrementally into a single container file.
+
+    Formats:
+        - 'npy': a preallocated (n_bscans, height, width) uint8 .npy file written through a memory
+          map, so slices can be written in any order (also from pool workers opening it with
+          create=False) and read back with np.load(path, mmap_mode='r')[idx].
+        - 'tiff': a multi-page TIFF with one page per B-scan, appended in order.
+
+    Methods:
+        - write(): Writes the B-scan at the given index of the volume.
+        - close(): Flushes and closes the container.
+    """
+    extensions = {'npy': '.npy', 'tiff': '.tif'}
+
+    def __init__(self, save_path: str, output_format: str, n_bscans: int, image_shape: tuple, create: bool = True):
+        assert output_format in self.extensions, f"Error: Unknown output_format ({output_format}), options are 'png', 'npy' and 'tiff'."
+        self.save_path = save_path
+        self.output_format = output_format
+        os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+        if output_format == 'npy':
+            self.volume = np.lib.format.open_memmap(save_path, mode='w+' if create else 'r+', dtype=np.uint8, shape=(n_bscans,) + tuple(image_shape))
+        else:
+            self.tiff_writer = TiffImagePlugin.AppendingTiffWriter(save_path, new=create)
+
+    def write(self, bscan_idx: int, bscan_image: np.ndarray, profiler: PipelineProfiler | None = None) -> None:
+        with profile_stage(profiler, 'write', bscan_image.nbytes):
+            if self.output_format == 'npy':
+                self.volume[bscan_idx] = bscan_image
+            else:
+                Image.fromarray(bscan_image).save(self.tiff_writer)
+                self.tiff_writer.newFrame()
+
+    def close(self) -> None:
+        if self.output_format == 'npy':
+            self.volume.flush()
+            del self.volume
+        else:
+            self.tiff_writer.close()
+
+def get_volume_output_path(save_folder: str, file_idx: int, output_format: str) -> str:
+    """Returns the container path of the processed volume of a large file."""
+    return os.path.join(save_folder, f"volume_{file_idx}{VolumeOutputWriter.extensions[output_format]}")
+
+class EnFaceAccumulator:
+    """
+    Builds the en-face mean and max intensity projections of a volume, one row per averaged B-scan.
+
+    The rows are kept in a (2, n_bscans, width) float32 .npy file (mean first, then max) written
+    through a memory map, so the projections never hold more than one en-face image, pool
+    workers can fill their own rows (create=False) and a resumed run keeps the rows it already had.
+
+    Methods:
+        - add(): Stores the projection rows of the averaged B-scan at the given index.
+        - save_images(): Normalizes the projections and saves them as enface_mean/max_{file_idx}.png.
+        - close(): Flushes and closes the projections file.
+    """
+    def __init__(self, save_folder: str, file_idx: int, n_bscans: int, width: int, create: bool = True):
+        self.save_folder = save_folder
+        self.file_idx = file_idx
+        os.makedirs(save_folder, exist_ok=True)
+        self.projections = np.lib.format.open_memmap(os.path.join(save_folder, f"enface_{file_idx}.npy"), mode='w+' if create else 'r+', dtype=np.float32, shape=(2, n_bscans, width))
+
+    def add(self, bscan_idx: int, projections: dict) -> None:
+        self.projections[0, bscan_idx] = projections['mean']
+        self.projections[1, bscan_idx] = projections['max']
+
+    def save_images(self, normalize_func) -> None:
+        for name, projection in zip(('mean', 'max'), self.projections):
+            enface_image = normalize_func(np.asarray(projection)).astype(np.uint8)
+            save_bscan_image(enface_image, os.path.join(self.save_folder, f"enface_{name}_{self.file_idx}.png"))
+
+    def close(self) -> None:
+        self.projections.flush()
+        del self.projections
+
+class AngiographyVolume:
+    """
+    Keeps the OCTA image of every batch of a large file in a float32 (n_bscans, height, width) .npy file.
+
+    Like the en-face projections, it is written through a memory map so pool workers can fill
+    their own images (create=False) and resumed runs keep the images they already had.
+
+    Methods:
+        - add(): Stores the OCTA image of a batch, also saving it as angio_{file_idx}_{batch_idx}.png if requested.
+        - close(): Flushes and closes the file.
+    """
+    def __init__(self, save_folder: str, file_idx: int, n_bscans: int, image_shape: tuple, method: str, create: bool = True):
+        self.save_folder = save_folder
+        self.file_idx = file_idx
+        self.method = method
+        os.makedirs(save_folder, exist_ok=True)
+        self.images = np.lib.format.open_memmap(os.path.join(save_folder, f"angiography_{file_idx}.npy"), mode='w+' if create else 'r+', dtype=np.float32, shape=(n_bscans,) + tuple(image_shape))
+
+    def add(self, bscan_idx: int, angiography_image: np.ndarray, save_png: bool = True, profiler: PipelineProfiler | None = None) -> None:
+        self.images[bscan_idx] = angiography_image
+        if save_png:
+            # Decorrelation is already in [0, 1], the variance is scaled from 0 to its maximum
+            peak = 1.0 if self.method == 'decorrelation' else float(angiography_image.max())
+            png_image = np.clip(angiography_image * (255 / peak), 0, 255).astype(np.uint8) if peak > 0 else np.zeros(angiography_image.shape, dtype=np.uint8)
+            save_bscan_image(png_image, os.path.join(self.save_folder, f"angio_{self.file_idx}_{bscan_idx}.png"), profiler)
+
+    def close(self) -> None:
+        self.images.flush()
+        del self.images
+
+def output_bscan_image(bscan_image: np.ndarray, file_idx: int, batch_idx: int, save_folder: str, save_image: bool, volume_writer: VolumeOutputWriter | None = None, profiler: PipelineProfiler | None = None) -> None:
+    """Writes a processed B-scan into its volume container or PNG file, or displays it."""
+    if volume_writer is not None:
+        volume_writer.write(batch_idx, bscan_image, profiler)
+    elif save_image:
+        save_bscan_image(bscan_image, os.path.join(save_folder, f"bscan_{file_idx}_{batch_idx}.png"), profiler)
+    else:
+        plt.imshow(bscan_image, cmap='gray')
+        plt.colorbar()
+        plt.title(f"B-scan {file_idx}_{batch_idx}")
+        plt.show()
+
+
+# Memory budget
+PROCESS_BASE_MEMORY = 150 * 1024 ** 2 # Interpreter, NumPy, OpenCV and Matplotlib of one process
+
+def parse_memory_size(value) -> int:
+    """Converts a memory size such as '16GB', '512 MB' or a number of bytes into bytes."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(value), re.IGNORECASE)
+    assert match, f"Error: Unknown memory size ({value}), use for example '16GB' or '512MB'."
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+def format_memory_size(n_bytes: int) -> str:
+    return f"{n_bytes / 1024 ** 3:.2f} GB" if n_bytes >= 1024 ** 3 else f"{n_bytes / 1024 ** 2:.0f} MB"
+
+def estimate_batch_memory(layout: RawLayout, batch_size: int, streaming_average: bool, register: bool, read_chunk: int = 1, registration_chunk: int = 1) -> int:
+    """Estimates the peak bytes one process needs to convert a batch, besides the interpreter itself.
+
+    Counts the raw B-scans read at once, their float32 magnitudes, the registered and stacked
+    copies of the averaging, and the post-processing buffers. Pages of memory-mapped files are
+    left out since the kernel can drop them under pressure. It is meant for sizing, not as an exact measure.
+    In place, the registration_chunk B-scans registered together are held with their registered copies.
+    """
+    image_bytes = layout.output_width * layout.output_height * 4
+    registration_bytes = 4 * image_bytes if register else 0 # Reference, its pyramid, warped image and ECC gradients
+    if streaming_average:
+        batch_bytes = read_chunk * (layout.bscan_bytes + image_bytes) + 2 * image_bytes # Read chunk, running sum and current image
+        if register:
+            batch_bytes += (registration_chunk - 1) * 3 * image_bytes # Gathered images, registered copies and per-image registration buffers
+    else:
+        # The raw block is released once converted, then the magnitudes, registered copies and stacked copy of np.mean coexist
+        batch_bytes = batch_size * max(layout.bscan_bytes + image_bytes, (3 if register else 2) * image_bytes)
+    return batch_bytes + registration_bytes + 3 * image_bytes # Post-processing buffers
+
+def plan_memory_budget(max_memory: int, layout: RawLayout, batch_size: int, workers: int, streaming_average: bool, register: bool, prefetch_batches: int = 0, registration_chunk: int = 1) -> dict:
+    """Chooses the averaging path, the B-scans read at a time and the worker processes that fit in max_memory bytes.
+
+    Options go from reading each batch at once to accumulating it in place while reading fewer
+    B-scans at a time. The option that fits the most workers (up to the requested ones) wins,
+    and if none fits with one process the smallest one is returned with fits set to False.
+    A sequential run also holds the prefetch_batches read ahead (B-scans with in-place averaging).
+    """
+    def get_total_memory(n_workers: int, streaming: bool, read_chunk: int) -> int:
+        process_memory = PROCESS_BASE_MEMORY + estimate_batch_memory(layout, batch_size, streaming, register, read_chunk, registration_chunk)
+        if n_workers <= 1:
+            return process_memory + prefetch_batches * (1 if streaming else batch_size) * layout.output_width * layout.output_height * 4
+        return PROCESS_BASE_MEMORY + n_workers * process_memory # Pool workers and the parent process
+
+    read_chunks = sorted({batch_size} | {read_chunk for read_chunk in (64, 32, 16, 8, 4, 2, 1) if read_chunk < batch_size}, reverse=True)
+    options = ([] if streaming_average else [(False, batch_size)]) + [(True, read_chunk) for read_chunk in read_chunks]
+    best_plan = None
+    for streaming, read_chunk in options:
+        fitting_workers = [n_workers for n_workers in range(1, max(workers, 1) + 1) if get_total_memory(n_workers, streaming, read_chunk) <= max_memory]
+        if fitting_workers and (best_plan is None or fitting_workers[-1] > best_plan['workers']):
+            best_plan = {'streaming_average': streaming, 'read_chunk': read_chunk, 'workers': fitting_workers[-1], 'fits': True}
+    if best_plan is None:
+        best_plan = {'streaming_average': True, 'read_chunk': 1, 'workers': 1, 'fits': False}
+    best_plan['estimated_bytes'] = get_total_memory(best_plan['workers'], best_plan['streaming_average'], best_plan['read_chunk'])
+    return best_plan
+
+
+# Resumable runs
+def get_config_hash(run_settings: dict) -> str:
+    """Hashes the settings that change the converted images, so outputs of another configuration are not reused."""
+    return hashlib.sha1(json.dumps(run_settings, sort_keys=True, default=str).encode()).hexdigest()
+
+class RunManifest:
+    """
+    Records the progress of a conversion next to its outputs so an interrupted or extended run can resume.
+
+    For every input file it keeps its size, mtime, index in the run, the config hash and the
+    batch indices whose outputs are already written. An entry is only reused when all of these
+    still match, otherwise the file is converted again from the start.
+
+    Methods:
+        - completed_batches(): Batches of a file already converted by a previous run.
+        - start_file(): (Re)starts the entry of a file.
+        - mark_batch(): Records a written batch, saving the manifest at most every flush_interval seconds.
+        - flush(): Saves the manifest atomically.
+    """
+    def __init__(self, manifest_path: str, config_hash: str, flush_interval: float = 5.0):
+        self.manifest_path = manifest_path
+        self.config_hash = config_hash
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.files = {}
+        os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r') as manifest_file:
+                    self.files = json.load(manifest_file).get('files', {})
+            except (OSError, ValueError) as e:
+                print(f"Warning: Ignoring unreadable manifest {manifest_path}: {e}")
+
+    @staticmethod
+    def get_file_stamp(filepath: str, file_idx: int) -> dict:
+        file_stat = os.stat(filepath)
+        return {'file_idx': file_idx, 'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+
+    def completed_batches(self, filename: str, filepath: str, file_idx: int) -> set[int]:
+        entry = self.files.get(filename)
+        if entry is None or entry.get('config_hash') != self.config_hash:
+            return set()
+        if any(entry.get(key) != value for key, value in self.get_file_stamp(filepath, file_idx).items()):
+            return set()
+        return set(entry['completed_batches'])
+
+    def start_file(self, filename: str, filepath: str, file_idx: int, n_batches: int, completed: set[int]) -> None:
+        self.files[filename] = {**self.get_file_stamp(filepath, file_idx), 'config_hash': self.config_hash,
+                                'n_batches': n_batches, 'completed_batches': sorted(completed)}
+        self.flush()
+
+    def mark_batch(self, filename: str, batch_idx: int) -> None:
+        self.files[filename]['completed_batches'].append(batch_idx)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        # Written to a temporary file first so an interruption never leaves a truncated manifest
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({'files': self.files}, manifest_file)
+        os.replace(temp_path, self.manifest_path)
+        self.last_flush = time.monotonic()
+
+def get_present_batches(save_folder: str, file_idx: int, completed: set[int], output_format: str) -> set[int]:
+    """Returns the recorded batches whose PNG (or the volume container of their file) is still on disk."""
+    if output_format == 'png':
+        return {batch_idx for batch_idx in completed if os.path.exists(os.path.join(save_folder, f"bscan_{file_idx}_{batch_idx}.png"))}
+    return set(completed) if os.path.exists(get_volume_output_path(save_folder, file_idx, output_format)) else set()
+
+def plan_resumed_file(manifest: RunManifest | None, filename: str, filepath: str, file_idx: int, n_batches: int, output_format: str, save_folder: str, restart_partial: bool = False, batch_range: tuple | None = None) -> int:
+    """Returns the first batch of a file that is not converted yet and starts its manifest entry.
+
+    Only the [start, stop) batch_range of the file is considered (the whole file by default), and
+    stop is returned when it is finished. Batches are recorded in order, so the file resumes there.
+    A recorded batch whose output was deleted counts as not converted, so it is converted again.
+    TIFF pages can only be appended in order, so a partially written TIFF volume is converted again
+    from the start, as are all partial files with restart_partial (e.g. when the whole volume is
+    needed to normalize it).
+    """
+    batch_start, batch_stop = batch_range or (0, n_batches)
+    if manifest is None:
+        return batch_start
+    completed = get_present_batches(save_folder, file_idx, manifest.completed_batches(filename, filepath, file_idx), output_format)
+    first_batch = next(batch_idx for batch_idx in range(batch_start, batch_stop + 1) if batch_idx not in completed)
+    if (output_format == 'tiff' or restart_partial) and first_batch < batch_stop:
+        first_batch = batch_start
+    manifest.start_file(filename, filepath, file_idx, n_batches, set(range(batch_start, first_batch)))
+    return first_batch
+
+
+# Sharded runs
+def parse_shard(shard) -> tuple[int, int] | None:
+    """Converts a shard such as '2/8' or [2, 8] (the third of eight, counting from 0) into (shard_index, shard_count)."""
+    if shard is None or shard == '':
+        return None
+    shard_index, shard_count = (int(value) for value in (shard.split('/') if isinstance(shard, str) else shard))
+    assert 0 <= shard_index < shard_count, f"Error: Unknown shard ({shard}), use i/N with 0 <= i < N."
+    return shard_index, shard_count
+
+def get_shard_suffix(shard: tuple[int, int] | None) -> str:
+    return f"_shard{shard[0]}of{shard[1]}" if shard is not None else ''
+
+def plan_shard_work(n_files: int, n_batches: int, shard: tuple[int, int] | None, split_files: bool = True) -> dict[int, tuple[int, int]]:
+    """Returns the [start, stop) batch range of every file a shard converts, as {file_idx: (start, stop)}.
+
+    The (file, batch) units of all files, in order, are split into shard_count contiguous ranges
+    whose sizes differ by one unit at most. Without split_files the units are whole files. Every
+    shard computes the same plan from the same files, so none of them overlap.
+    """
+    if shard is None:
+        return {file_idx: (0, n_batches) for file_idx in range(n_files)}
+    shard_index, shard_count = shard
+    if not split_files:
+        return {file_idx: (0, n_batches) for file_idx in range(shard_index * n_files // shard_count, (shard_index + 1) * n_files // shard_count)}
+    n_units = n_files * n_batches
+    unit_start, unit_stop = shard_index * n_units // shard_count, (shard_index + 1) * n_units // shard_count
+    shard_work = {}
+    for file_idx in range(unit_start // n_batches if n_batches else 0, n_files):
+        start, stop = max(unit_start - file_idx * n_batches, 0), min(unit_stop - file_idx * n_batches, n_batches)
+        if start >= stop:
+            break
+        shard_work[file_idx] = (start, stop)
+    return shard_work
+
+def merge_shard_manifests(folder: str, save_folder: str, n_batches: int, shard_count: int, output_format: str = 'png') -> dict[str, list[int]]:
+    """Merges the manifests of an N-shard run into manifest.json and checks that every batch output exists.
 
-    # Process files in folder
+    A batch counts as present when a shard recorded it and its PNG (or the volume container of its
+    file) is on disk. The merged manifest lets an unsharded run with resume pick up what is missing.
+
+    Returns:
+        dict: {filename: [missing batch indices]} for the files that are not complete (empty when the run is complete).
+    """
+    files = sort_filenames_by_number(sorted(f for f in os.listdir(folder) if f.endswith('.raw')))
+    entries = {}
+    config_hashes = set()
+    for shard_index in range(shard_count):
+        manifest_path = os.path.join(save_folder, f"manifest{get_shard_suffix((shard_index, shard_count))}.json")
+        if not os.path.exists(manifest_path):
+            print(f"Warning: Shard {shard_index}/{shard_count} has no manifest ({manifest_path}), its batches count as missing.")
+            continue
+        for filename, entry in RunManifest(manifest_path, None).files.items():
+            config_hashes.add(entry['config_hash'])
+            merged_entry = entries.setdefault(filename, {**entry, 'completed_batches': []})
+            merged_entry['completed_batches'] = sorted(set(merged_entry['completed_batches']) | set(entry['completed_batches']))
+    assert len(config_hashes) <= 1, f"Error: The shards were run with {len(config_hashes)} different configurations, they can't be merged."
+
+    merged_manifest = RunManifest(os.path.join(save_folder, 'manifest.json'), config_hashes.pop() if config_hashes else None)
+    merged_manifest.files = entries
+    merged_manifest.flush()
+
+    missing = {}
+    for file_idx, filename in enumerate(files):
+        present = get_present_batches(save_folder, file_idx, set(entries.get(filename, {}).get('completed_batches', [])), output_format)
+        if len(present & set(range(n_batches))) < n_batches:
+            missing[filename] = sorted(set(range(n_batches)) - present)
+    n_missing = sum(len(batches) for batches in missing.values())
+    print(f"Merged {shard_count} shards: {len(files) * n_batches - n_missing}/{len(files) * n_batches} batches of {len(files)} files present")
+    for filename, batches in missing.items():
+        print(f"Missing in {filename}: batches {batches}")
+    return missing
+
+
+# Volume-level normalization
+def get_averaged_volume_path(save_folder: str, file_idx: int) -> str:
+    """Returns the path of the temporary volume with the averaged B-scans of a large file."""
+    return os.path.join(save_folder, f"averaged_{file_idx}.tmp.npy")
+
+def open_averaged_volume(save_folder: str, file_idx: int, n_bscans: int, image_shape: tuple, create: bool = True) -> np.memmap:
+    """Maps the temporary float32 volume that keeps the averaged B-scans of a file until its intensity bounds are known."""
+    os.makedirs(save_folder, exist_ok=True)
+    return np.lib.format.open_memmap(get_averaged_volume_path(save_folder, file_idx), mode='w+' if create else 'r+', dtype=np.float32, shape=(n_bscans,) + tuple(image_shape))
+
+def write_volume_normalized_bscans(averaged_volume: np.ndarray, histogram: StreamingHistogram, percentiles: tuple, clahe, file_idx: int, filename: str, save_folder: str, save_image: bool, volume_writer: VolumeOutputWriter | None = None, profiler: PipelineProfiler | None = None, manifest: RunManifest | None = None, total_files: int = 1) -> None:
+    """Second pass of the volume normalization: maps every averaged B-scan of a file between the percentile bounds of the whole volume.
+
+    The bounds come from the histogram streamed during the first pass, so only the stored float
+    B-scans are read again and nothing is sorted.
+    """
+    lower_bound, upper_bound = histogram.percentiles(percentiles)
+    post_processing_chain = PostProcessingChain(True, functools.partial(normalize_image_to_bounds, lower_bound=lower_bound, upper_bound=upper_bound), clahe)
+    print()
+    for batch_idx in range(len(averaged_volume)):
+        if profiler is not None:
+            profiler.start_batch(file_idx, batch_idx)
+        bscan_image = post_processing_chain(averaged_volume[batch_idx], profiler)
+        output_bscan_image(bscan_image, file_idx, batch_idx, save_folder, save_image, volume_writer, profiler)
+        if profiler is not None:
+            profiler.end_batch()
+        if manifest is not None:
+            manifest.mark_batch(filename, batch_idx)
+        print_loading_bar(batch_idx + 1, len(averaged_volume), previous_message=f'Normalizing batches in file {file_idx + 1}/{total_files}')
+
+
+# Process pool execution of large files
+_batch_worker_settings = {}
+
+def init_batch_worker(settings: dict) -> None:
+    """Stores the run settings in a pool worker and creates its own CLAHE operator and post-processing buffers."""
+    _batch_worker_settings.clear()
+    _batch_worker_settings.update(settings)
+    _batch_worker_settings['clahe'] = create_clahe(settings['post_processing_dic'])
+    _batch_worker_settings['post_processing_chain'] = PostProcessingChain(settings['normalize_postprocessed'], settings['normalize_func'], _batch_worker_settings['clahe'])
+    _batch_worker_settings['angiography'] = AngiographyAccumulator(settings['angiography_method']) if settings.get('angiography_method') else None
+
+def process_batch_task(task: tuple) -> tuple:
+    """Processes one batch of a large file inside a pool worker and saves its image.
+
+    The worker maps the raw file itself, so the B-scans are shared through the page cache
+    instead of being pickled from the parent process. Only the task indices travel back.
+    """
+    filepath, file_idx, batch_idx, start, stop = task
+    settings = _batch_worker_settings
+    width, height = settings['image_size']
+    profiler = PipelineProfiler() if settings.get('profile', False) else None
+    if profiler is not None:
+        profiler.start_batch(file_idx, batch_idx)
+    volume = open_raw_volume(filepath, settings['data_format'], width, height, settings['n_slices_in_volume'], settings['raw_layout'])
+    if settings['streaming_average']:
+        bscan_batch = iter_bscan_images(volume, start, stop, settings['normalize_func'], settings['normalize_individual'], profiler, settings.get('read_chunk', 1))
+    else:
+        bscan_batch = read_bscan_block(volume, start, stop, settings['normalize_func'], settings['normalize_individual'], profiler)
+
+    registration_state = {}
+    projections = {} if settings['enface'] else None
+    averaged_bscan = average_bscan_batch(bscan_batch, settings['post_processing_average_per_n_slices'], settings['post_processing_dic'], settings['streaming_average'], registration_state, profiler, projections, settings['angiography'])
+    if projections is not None:
+        enface_accumulator = EnFaceAccumulator(settings['save_folder'], file_idx, settings['n_batches'], width, create=False)
+        enface_accumulator.add(batch_idx, projections)
+        enface_accumulator.close()
+    if settings['angiography'] is not None:
+        angiography_volume = AngiographyVolume(settings['save_folder'], file_idx, settings['n_batches'], (height, width), settings['angiography_method'], create=False)
+        angiography_volume.add(batch_idx, settings['angiography'].result(), settings['output_format'] == 'png', profiler)
+        angiography_volume.close()
+
+    # With volume normalization the averaged B-scan is stored and counted, the parent process writes the images
+    if settings['volume_normalization']:
+        with profile_stage(profiler, 'normalize', averaged_bscan.nbytes):
+            averaged_volume = open_averaged_volume(settings['save_folder'], file_idx, settings['n_batches'], averaged_bscan.shape, create=False)
+            averaged_volume[batch_idx] = averaged_bscan
+            averaged_volume.flush()
+            del averaged_volume
+            histogram = StreamingHistogram()
+            histogram.add(averaged_bscan)
+        profile_record = profiler.end_batch() if profiler is not None else None
+        return file_idx, batch_idx, registration_state.get('details', []), None, profile_record, histogram
+    averaged_bscan = settings['post_processing_chain'](averaged_bscan, profiler)
+
+    # PNGs and .npy slots are written here, TIFF pages are appended in order by the parent process
+    output_format = settings['output_format']
+    if output_format == 'png':
+        save_bscan_image(averaged_bscan, os.path.join(settings['save_folder'], f"bscan_{file_idx}_{batch_idx}.png"), profiler)
+    elif output_format == 'npy':
+        writer = VolumeOutputWriter(get_volume_output_path(settings['save_folder'], file_idx, output_format), output_format, settings['n_batches'], averaged_bscan.shape, create=False)
+        writer.write(batch_idx, averaged_bscan, profiler)
+        writer.close()
+    profile_record = profiler.end_batch() if profiler is not None else None
+    return file_idx, batch_idx, registration_state.get('details', []), averaged_bscan if output_format == 'tiff' else None, profile_record, None
+
+def process_large_files_in_pool(folder: str, files: list[str], settings: dict, workers: int, manifest: RunManifest | None = None, shard_work: dict[int, tuple[int, int]] | None = None) -> None:
+    """Spreads the batches of all large files across a process pool, reporting them in file and batch order.
+
+    Each batch starts its registration from the identity, as batches no longer run one after the other.
+    When profiling, the stage timings measured by the workers are collected in the parent process.
+    Batches already recorded in the manifest, or outside the shard_work of this shard, are not submitted.
+    """
+    total_files = len(files)
+    n_slices_in_volume = settings['n_slices_in_volume']
+    batch_size = settings['post_processing_average_per_n_slices']
+    total_batches = n_slices_in_volume // batch_size
+    output_format = settings['output_format']
+    width, height = settings['image_size']
+    shard_work = shard_work if shard_work is not None else plan_shard_work(total_files, settings['n_batches'], None)
+    shard_suffix = settings.get('shard_suffix', '')
+
+    # One task per missing batch, ordered by file and batch so the results come back deterministically
+    tasks = []
     for file_idx, filename in enumerate(files):
-        print(f"Processing file {file_idx + 1}/{total_files}: {filename}")
+        if file_idx not in shard_work:
+            continue
+        batch_start, batch_stop = shard_work[file_idx]
         filepath = os.path.join(folder, filename)
+        first_batch = plan_resumed_file(manifest, filename, filepath, file_idx, settings['n_batches'], output_format, settings['save_folder'], settings['volume_normalization'], shard_work[file_idx])
+        if first_batch >= batch_stop:
+            print(f"Skipping file {file_idx + 1}/{total_files}: {filename} (already converted)")
+            continue
 
-        # Process the large file in batches
-        total_batches = n_slices_in_volume // post_processing_average_per_n_slices
-        print_loading_bar(0, total_batches, previous_message=f'Processing batches in file {file_idx + 1}/{total_files}')
-        for batch_idx, bscan_batch in enumerate(read_large_file_in_batches(filepath, data_format, width, height, n_slices_in_volume, post_processing_average_per_n_slices, normalize_func, normalize_individual)):
-            # Average the batch
-            if post_processing_average_per_n_slices > 1:
-                if post_processing_dic['register_images_pre_average'] == True: # Register images
-                    bscan_batch = register_images(bscan_batch[0], bscan_batch)
-                averaged_bscan = np.mean(bscan_batch, axis=0)
-            else:
-                averaged_bscan = np.array(bscan_batch)[0]
-            
-            # Normalize averaged images
-            if normalize_postprocessed:
-                averaged_bscan = normalize_func(averaged_bscan)
-            averaged_bscan = averaged_bscan.astype(np.uint8)
-
-            # Postprocess final image if necessary
-            if post_processing_dic['clahe'] == True:
-                averaged_bscan = clahe.apply(averaged_bscan)
-
-            # Save or display the image
-            out_filename = f"bscan_{file_idx}_{batch_idx}.png"
-            if save_image:
-                image = Image.fromarray(averaged_bscan)
-                save_path = os.path.join(save_folder, out_filename)
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                image.save(save_path)
-            else:
-                plt.imshow(averaged_bscan, cmap='gray')
-                plt.colorbar()
-                plt.title(f"B-scan {file_idx}_{batch_idx}")
-                plt.show()
+        # Create the volume containers and projections before the workers start writing into them
+        if output_format != 'png' and first_batch == 0:
+            VolumeOutputWriter(get_volume_output_path(settings['save_folder'], file_idx, output_format), output_format, settings['n_batches'], (height, width)).close()
+        if settings['enface'] and first_batch == 0:
+            EnFaceAccumulator(settings['save_folder'], file_idx, settings['n_batches'], width).close()
+        if settings.get('angiography_method') and first_batch == 0:
+            AngiographyVolume(settings['save_folder'], file_idx, settings['n_batches'], (height, width), settings['angiography_method']).close()
+        if settings['volume_normalization']:
+            open_averaged_volume(settings['save_folder'], file_idx, settings['n_batches'], (height, width)).flush()
+        tasks.extend((filepath, file_idx, batch_idx, bscan_idx, min(bscan_idx + batch_size, n_slices_in_volume))
+                     for batch_idx, bscan_idx in enumerate(range(0, n_slices_in_volume, batch_size))
+                     if first_batch <= batch_idx < batch_stop)
 
-            # Print the progress bar for batches
+    profiler = PipelineProfiler() if settings.get('profile', False) else None
+    with multiprocessing.Pool(workers, initializer=init_batch_worker, initargs=(settings,)) as pool:
+        current_file_idx = -1
+        tiff_writer = None
+        volume_histogram = None
+        for file_idx, batch_idx, registration_details, averaged_bscan, profile_record, batch_histogram in pool.imap(process_batch_task, tasks):
+            if settings['post_processing_dic'].get('registration_report', False) and registration_details:
+                write_registration_report(os.path.join(settings['save_folder'], f"registration_report{shard_suffix}.csv"), file_idx, batch_idx, registration_details)
+            if file_idx != current_file_idx:
+                if current_file_idx >= 0:
+                    print()
+                current_file_idx = file_idx
+                print(f"Processing file {file_idx + 1}/{total_files}: {files[file_idx]}")
+                if output_format == 'tiff':
+                    if tiff_writer is not None:
+                        tiff_writer.close()
+                    tiff_writer = VolumeOutputWriter(get_volume_output_path(settings['save_folder'], file_idx, output_format), output_format, settings['n_batches'], (height, width))
+            if tiff_writer is not None and averaged_bscan is not None:
+                write_start = time.perf_counter()
+                tiff_writer.write(batch_idx, averaged_bscan)
+                if profile_record is not None:
+                    profile_record['seconds']['write'] += time.perf_counter() - write_start
+                    profile_record['bytes']['write'] += averaged_bscan.nbytes
+            if settings['enface'] and batch_idx == settings['n_batches'] - 1: # All rows of the file are written
+                enface_accumulator = EnFaceAccumulator(settings['save_folder'], file_idx, settings['n_batches'], width, create=False)
+                enface_accumulator.save_images(settings['normalize_func'])
+                enface_accumulator.close()
+            if profiler is not None:
+                profiler.add_batch(profile_record)
             print_loading_bar(batch_idx + 1, total_batches, previous_message=f'Processing batches in file {file_idx + 1}/{total_files}')
 
+            if batch_histogram is None:
+                if manifest is not None:
+                    manifest.mark_batch(files[file_idx], batch_idx)
+                continue
 
-# Processing individual files (OLD FORMAT)
-def load_and_preprocess_images(folder: str, n_slices_in_volume: int, cycle_of_repeated_bscan: int, image_size: tuple, normalize_individual: bool, normalize_func) -> dict:
-    """Loads and preprocesses images from the folder."""
-    files = os.listdir(folder)
-    files = sort_filenames_by_number(files)
-    processed_volume_slices = {}
+            # Volume normalization: gather the histogram of the file, then write its images once all batches are averaged
+            if batch_idx == 0:
+                volume_histogram = StreamingHistogram()
+            volume_histogram.merge(batch_histogram)
+            if batch_idx == settings['n_batches'] - 1:
+                averaged_volume = open_averaged_volume(settings['save_folder'], file_idx, settings['n_batches'], (height, width), create=False)
+                volume_writer = tiff_writer
+                if output_format == 'npy':
+                    volume_writer = VolumeOutputWriter(get_volume_output_path(settings['save_folder'], file_idx, output_format), output_format, settings['n_batches'], (height, width), create=False)
+                write_volume_normalized_bscans(averaged_volume, volume_histogram, settings['normalization_percentiles'], create_clahe(settings['post_processing_dic']), file_idx, files[file_idx],
+                                               settings['save_folder'], True, volume_writer, profiler, manifest, total_files)
+                if output_format == 'npy':
+                    volume_writer.close()
+                del averaged_volume
+                os.remove(get_averaged_volume_path(settings['save_folder'], file_idx))
+        if tiff_writer is not None:
+            tiff_writer.close()
+    if profiler is not None:
+        profiler.save(settings['save_folder'], f"profile{shard_suffix}")
 
-    for counter, filename in enumerate(files):
-        print_loading_bar(counter, len(files), 'Reading images')
+def get_large_file_settings(config: dict, shard=None) -> dict:
+    """Builds the settings of process_large_files_in_folder from the configuration, with the defaults of every optional key."""
+    data_format = config.get('data_format', 'float32')
+    return {
+        'folder': config['folder'],
+        'save_folder': config['save_folder'],
+        'n_slices_in_volume': config['n_slices_in_volume'],
+        'post_processing_average_per_n_slices': config['post_processing_average_per_n_slices'],
+        'image_size': tuple(config['image_size']),
+        'data_format': data_format,
+        'normalize_individual': config['normalize_individual_image'],
+        'normalize_postprocessed': config['normalize_postprocessed_images'],
+        'normalize_func': normalize_image_complex64 if data_format.startswith('complex') else normalize_image_float32,
+        'post_processing_dic': config['post_process_image'],
+        'save_image': config['save_image'],
+        'use_memmap_reader': config.get('use_memmap_reader', False),
+        'streaming_average': config.get('streaming_average', False),
+        'workers': config.get('workers', 1),
+        'output_format': config.get('output_format', 'png'),
+        'profile': config.get('profile', False),
+        'resume': config.get('resume', False),
+        'raw_layout': config.get('raw_layout', {}),
+        'enface': config.get('enface_projections', False),
+        'normalization_mode': config.get('normalization_mode', 'image'),
+        'normalization_percentiles': tuple(config.get('normalization_percentiles', (0.5, 99.5))),
+        'max_memory': config.get('max_memory', None),
+        'roi': config.get('roi', {}),
+        'prefetch_batches': config.get('prefetch_batches', 0),
+        'shard': shard or config.get('shard', None),
+        'angiography': config.get('angiography', {}),
+    }
+
+def process_large_files_in_folder(settings: dict) -> None:
+    """Processes all large files in the folder containing multiple B-scans, with the settings of get_large_file_settings."""
+    folder, save_folder, save_image = settings['folder'], settings['save_folder'], settings['save_image']
+    n_slices_in_volume, post_processing_average_per_n_slices = settings['n_slices_in_volume'], settings['post_processing_average_per_n_slices']
+    image_size, data_format, raw_layout, roi = settings['image_size'], settings['data_format'], settings['raw_layout'], settings['roi']
+    normalize_individual, normalize_postprocessed, normalize_func = settings['normalize_individual'], settings['normalize_postprocessed'], settings['normalize_func']
+    normalization_mode, normalization_percentiles = settings['normalization_mode'], settings['normalization_percentiles']
+    post_processing_dic, enface, angiography = settings['post_processing_dic'], settings['enface'], settings['angiography']
+    use_memmap_reader, streaming_average, prefetch_batches = settings['use_memmap_reader'], settings['streaming_average'], settings['prefetch_batches']
+    workers, max_memory, output_format, profile, resume = settings['workers'], settings['max_memory'], settings['output_format'], settings['profile'], settings['resume']
+
+    files = sort_filenames_by_number(sorted(f for f in os.listdir(folder) if f.endswith('.raw')))
+    total_files = len(files)
+    layout = create_raw_layout(data_format, image_size, raw_layout, roi)
+    validate_raw_files(folder, files, layout, n_slices_in_volume)
 
-        # Determine current volume and slice
-        if counter % n_slices_in_volume == 0:
-            id_volume = int(counter / n_slices_in_volume)
-            processed_volume_slices[id_volume] = {}
+    # Only the region of interest is read from here on
+    first_bscan, last_bscan = (roi or {}).get('bscan_range') or (0, n_slices_in_volume)
+    assert 0 <= first_bscan < last_bscan <= n_slices_in_volume, f"Error: bscan_range ({[first_bscan, last_bscan]}) must be within the {n_slices_in_volume} B-scans of a file."
+    layout.skip_bscans(first_bscan)
+    n_slices_in_volume = last_bscan - first_bscan
+    width, height = layout.output_width, layout.output_height
+    n_batches = len(range(0, n_slices_in_volume, post_processing_average_per_n_slices))
+    assert normalization_mode in ('image', 'volume'), f"Error: Unknown normalization_mode ({normalization_mode}), options are 'image' and 'volume'."
+    volume_normalization = normalize_postprocessed and normalization_mode == 'volume'
+    angiography_method = (angiography or {}).get('method', 'decorrelation') if (angiography or {}).get('enabled', False) and save_image else None
 
-        id_slice = int(counter % cycle_of_repeated_bscan)
-        if id_slice not in processed_volume_slices[id_volume]:
-            processed_volume_slices[id_volume][id_slice] = []
+    # Files are only cut into batch ranges when no output needs a whole file in one process
+    shard = parse_shard(settings['shard'])
+    shard_suffix = get_shard_suffix(shard)
+    shard_work = plan_shard_work(total_files, n_batches, shard, output_format == 'png' and not enface and not volume_normalization and not angiography_method)
+    if shard is not None:
+        print(f"Shard {shard[0]}/{shard[1]}: {sum(stop - start for start, stop in shard_work.values())} batches of {len(shard_work)} files")
 
-        # Read and convert binary data
-        file_path = os.path.join(folder, filename)
-        with open(file_path, 'rb') as file:
-            raw_data = file.read()
+    # Fit the averaging path, read size and processes in the memory budget before starting
+    if workers == 0:
+        workers = os.cpu_count()
+    read_chunk = 1
+    if max_memory:
+        max_memory_bytes = parse_memory_size(max_memory)
+        register = post_processing_average_per_n_slices > 1 and post_processing_dic['register_images_pre_average'] == True
+        memory_plan = plan_memory_budget(max_memory_bytes, layout, post_processing_average_per_n_slices, workers if save_image else 1, streaming_average, register, prefetch_batches,
+                                         get_registration_chunk(post_processing_dic))
+        streaming_average, read_chunk = memory_plan['streaming_average'], memory_plan['read_chunk']
+        workers = memory_plan['workers'] if save_image else workers
+        if not memory_plan['fits']:
+            print(f"Warning: The estimated peak memory ({format_memory_size(memory_plan['estimated_bytes'])}) exceeds max_memory ({format_memory_size(max_memory_bytes)}) even reading one B-scan at a time in one process, "
+                  f"reduce post_processing_average_per_n_slices or raise max_memory.")
+        else:
+            averaging = f"in place, reading {read_chunk} B-scans at a time" if streaming_average else "whole batches"
+            print(f"Memory budget {format_memory_size(max_memory_bytes)}: averaging {averaging} with {workers} worker(s), estimated peak {format_memory_size(memory_plan['estimated_bytes'])}")
 
-        num_bytes = len(raw_data)
-        num_floats = num_bytes // 4
-        float_array = np.array(struct.unpack('<' + 'f' * num_floats, raw_data), dtype=np.float32)
+    manifest = None
+    if save_image:
+        config_hash = get_config_hash({'n_slices_in_volume': n_slices_in_volume, 'post_processing_average_per_n_slices': post_processing_average_per_n_slices,
+                                       'image_size': image_size, 'data_format': data_format, 'normalize_individual': normalize_individual,
+                                       'normalize_postprocessed': normalize_postprocessed, 'post_processing_dic': post_processing_dic,
+                                       'streaming_average': streaming_average, 'output_format': output_format, 'raw_layout': raw_layout,
+                                       'enface': enface, 'normalization_mode': normalization_mode, 'normalization_percentiles': list(normalization_percentiles), 'roi': roi,
+                                       'angiography_method': angiography_method})
+        manifest = RunManifest(os.path.join(save_folder, f"manifest{shard_suffix}.json"), config_hash)
+        if not resume:
+            manifest.files = {}
 
-        assert len(float_array) == image_size[0] * image_size[1], f"Error: float_array len ({len(float_array)}) must be equal to image_size - Height x Width ({image_size[0] * image_size[1]})"
+    # Spread batches across processes (images can only be displayed from the main process)
+    if workers > 1 and save_image:
+        pool_settings = {'n_slices_in_volume': n_slices_in_volume, 'post_processing_average_per_n_slices': post_processing_average_per_n_slices,
+                    'image_size': (width, height), 'data_format': data_format, 'normalize_individual': normalize_individual,
+                    'normalize_postprocessed': normalize_postprocessed, 'normalize_func': normalize_func,
+                    'post_processing_dic': post_processing_dic, 'save_folder': save_folder, 'streaming_average': streaming_average,
+                    'output_format': output_format, 'n_batches': n_batches, 'profile': profile, 'raw_layout': layout,
+                    'enface': enface, 'volume_normalization': volume_normalization, 'normalization_percentiles': normalization_percentiles,
+                    'read_chunk': read_chunk, 'shard_suffix': shard_suffix, 'angiography_method': angiography_method}
+        try:
+            process_large_files_in_pool(folder, files, pool_settings, workers, manifest, shard_work)
+        finally:
+            manifest.flush()
+        return
 
-        image = float_array.reshape(image_size)
-        image = image[:, 10:]
-        image = np.rot90(image, k=3)
+    if streaming_average:
+        read_batches = functools.partial(read_large_file_in_streamed_batches, read_chunk=read_chunk)
+    elif use_memmap_reader:
+        read_batches = read_large_file_in_batches_memmap
+    else:
+        read_batches = read_large_file_in_batches
+    clahe = create_clahe(post_processing_dic)
+    post_processing_chain = PostProcessingChain(normalize_postprocessed, normalize_func, clahe)
+    angiography_accumulator = AngiographyAccumulator(angiography_method) if angiography_method else None
+    profiler = PipelineProfiler() if profile else None
 
-        if normalize_individual:
-            image = normalize_func(image)
+    # Process files in folder (the manifest is saved even when the run is interrupted)
+    prefetcher = None
+    try:
+        for file_idx, filename in enumerate(files):
+            if file_idx not in shard_work:
+                continue
+            batch_start, batch_stop = shard_work[file_idx]
+            filepath = os.path.join(folder, filename)
+            first_batch = plan_resumed_file(manifest, filename, filepath, file_idx, n_batches, output_format, save_folder, volume_normalization, shard_work[file_idx])
+            if first_batch >= batch_stop:
+                print(f"Skipping file {file_idx + 1}/{total_files}: {filename} (already converted)")
+                continue
+            print(f"Processing file {file_idx + 1}/{total_files}: {filename}")
 
-        processed_volume_slices[id_volume][id_slice].append(image)
+            # Process the large file in batches
+            total_batches = n_slices_in_volume // post_processing_average_per_n_slices
+            print_loading_bar(first_batch, total_batches, previous_message=f'Processing batches in file {file_idx + 1}/{total_files}')
+            registration_state = {}
+            volume_writer = None
+            if save_image and output_format != 'png':
+                volume_writer = VolumeOutputWriter(get_volume_output_path(save_folder, file_idx, output_format), output_format, n_batches, (height, width), create=first_batch == 0)
+            enface_accumulator = None
+            projections = None
+            if save_image and enface:
+                enface_accumulator = EnFaceAccumulator(save_folder, file_idx, n_batches, width, create=first_batch == 0)
+                projections = {}
+            angiography_volume = None
+            if angiography_accumulator is not None:
+                angiography_volume = AngiographyVolume(save_folder, file_idx, n_batches, (height, width), angiography_method, create=first_batch == 0)
+            averaged_volume = None
+            if volume_normalization:
+                averaged_volume = open_averaged_volume(save_folder, file_idx, n_batches, (height, width))
+                histogram = StreamingHistogram()
+            bscan_batches = read_batches(filepath, data_format, width, height, n_slices_in_volume, post_processing_average_per_n_slices, normalize_func, normalize_individual, profiler, first_batch * post_processing_average_per_n_slices, layout)
+            if prefetch_batches > 0:
+                bscan_batches = prefetcher = BatchPrefetcher(bscan_batches, prefetch_batches, profiler)
+            for batch_idx in range(first_batch, batch_stop):
+                # The batch is started before reading so the reader's stages are counted in it
+                if profiler is not None:
+                    profiler.start_batch(file_idx, batch_idx)
+                bscan_batch = next(bscan_batches)
+                averaged_bscan = average_bscan_batch(bscan_batch, post_processing_average_per_n_slices, post_processing_dic, streaming_average, registration_state, profiler, projections, angiography_accumulator)
+                if enface_accumulator is not None:
+                    enface_accumulator.add(batch_idx, projections)
+                if angiography_volume is not None:
+                    angiography_volume.add(batch_idx, angiography_accumulator.result(), output_format == 'png', profiler)
+                if post_processing_dic.get('registration_report', False) and registration_state.get('details'):
+                    write_registration_report(os.path.join(save_folder, f"registration_report{shard_suffix}.csv"), file_idx, batch_idx, registration_state.pop('details'))
+
+                if averaged_volume is not None:
+                    # Keep the averaged B-scan until the bounds of the whole volume are known
+                    with profile_stage(profiler, 'normalize', averaged_bscan.nbytes):
+                        averaged_volume[batch_idx] = averaged_bscan
+                        histogram.add(averaged_bscan)
+                else:
+                    # Save or display the image
+                    bscan_image = post_processing_chain(averaged_bscan, profiler)
+                    output_bscan_image(bscan_image, file_idx, batch_idx, save_folder, save_image, volume_writer, profiler)
+                    if manifest is not None:
+                        manifest.mark_batch(filename, batch_idx)
+
+                if profiler is not None:
+                    profiler.end_batch()
+
+                # Print the progress bar for batches
+                print_loading_bar(batch_idx + 1, total_batches, previous_message=f'Processing batches in file {file_idx + 1}/{total_files}')
+
+            if prefetcher is not None:
+                prefetcher.close()
+                print(f"\nWaited {prefetcher.stall_seconds:.2f} s for reads in file {file_idx + 1}/{total_files} (prefetch_batches: {prefetch_batches})")
+                prefetcher = None
+            if averaged_volume is not None:
+                write_volume_normalized_bscans(averaged_volume, histogram, normalization_percentiles, clahe, file_idx, filename, save_folder, save_image, volume_writer, profiler, manifest, total_files)
+                del averaged_volume
+                os.remove(get_averaged_volume_path(save_folder, file_idx))
+            if volume_writer is not None:
+                volume_writer.close()
+            if enface_accumulator is not None:
+                enface_accumulator.save_images(normalize_func)
+                enface_accumulator.close()
+            if angiography_volume is not None:
+                angiography_volume.close()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        if manifest is not None:
+            manifest.flush()
+
+    if profiler is not None:
+        profiler.save(save_folder, f"profile{shard_suffix}")
+
+
+# Quick-look previews of large files
+def read_preview_bscans(volume: np.ndarray, bscan_step: int, downsample: int) -> np.ndarray:
+    """Reads every bscan_step-th B-scan of a mapped volume and shrinks it downsample times, without registration.
+
+    Only the pages of the selected B-scans are read from the map, the others are never touched.
+    """
+    preview_bscans = []
+    for bscan_idx in range(0, len(volume), bscan_step):
+        bscan_image = bscans_to_images(volume[bscan_idx:bscan_idx + 1])[0]
+        if downsample > 1:
+            height, width = bscan_image.shape
+            bscan_image = cv2.resize(np.ascontiguousarray(bscan_image), (max(1, width // downsample), max(1, height // downsample)), interpolation=cv2.INTER_AREA)
+        preview_bscans.append(bscan_image)
+    return np.stack(preview_bscans)
+
+def build_contact_sheet(images: np.ndarray, columns: int, labels: list[str] | None = None, spacing: int = 2) -> np.ndarray:
+    """Tiles a (n, height, width) uint8 stack into one image, row by row, writing each label in the corner of its tile."""
+    n_images, height, width = images.shape
+    columns = max(1, min(columns, n_images))
+    rows = -(-n_images // columns)
+    sheet = np.zeros((rows * (height + spacing) - spacing, columns * (width + spacing) - spacing), dtype=np.uint8)
+    for idx, image in enumerate(images):
+        top, left = (idx // columns) * (height + spacing), (idx % columns) * (width + spacing)
+        sheet[top:top + height, left:left + width] = image
+        if labels is not None:
+            cv2.putText(sheet, labels[idx], (left + 2, top + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.3, 255, 1, cv2.LINE_AA)
+    return sheet
+
+def create_volume_preview(filepath: str, layout: RawLayout, num_bscans: int, normalize_func, save_path: str, bscan_step: int = 16, downsample: int = 4, columns: int = 8, preview_format: str = 'sheet') -> None:
+    """Saves a quick look of a large file as a PNG contact sheet or as a low resolution 'npy' or 'tiff' stack.
+
+    Each preview B-scan is normalized with the same function as the final images.
+    """
+    volume = layout.open(filepath, num_bscans)
+    preview_bscans = read_preview_bscans(volume, bscan_step, downsample)
+    preview_bscans = np.stack([normalize_func(bscan_image) for bscan_image in preview_bscans]).astype(np.uint8)
+    if preview_format == 'sheet':
+        labels = [str(bscan_idx) for bscan_idx in range(0, num_bscans, bscan_step)]
+        save_bscan_image(build_contact_sheet(preview_bscans, columns, labels), save_path)
+    else:
+        writer = VolumeOutputWriter(save_path, preview_format, len(preview_bscans), preview_bscans.shape[1:])
+        for idx, bscan_image in enumerate(preview_bscans):
+            writer.write(idx, bscan_image)
+        writer.close()
+
+def preview_large_files_in_folder(folder: str, n_slices_in_volume: int, image_size: tuple, data_format: str, normalize_func, save_folder: str, preview_dic: dict, raw_layout: dict | None = None) -> None:
+    """Saves a preview of every large file in the folder, skipping the files whose preview is newer than them.
+
+    The previews are written as preview_{filename}.png (or .npy / .tif) so new acquisitions can be
+    checked as soon as they land, by running the preview again on the same folder.
+    """
+    files = sort_filenames_by_number(sorted(f for f in os.listdir(folder) if f.endswith('.raw')))
+    layout = create_raw_layout(data_format, image_size, raw_layout)
+    validate_raw_files(folder, files, layout, n_slices_in_volume)
+    preview_format = preview_dic.get('format', 'sheet')
+    extension = '.png' if preview_format == 'sheet' else VolumeOutputWriter.extensions[preview_format]
+
+    for file_idx, filename in enumerate(files):
+        filepath = os.path.join(folder, filename)
+        save_path = os.path.join(save_folder, f"preview_{os.path.splitext(filename)[0]}{extension}")
+        if os.path.exists(save_path) and os.path.getmtime(save_path) >= os.path.getmtime(filepath):
+            continue
+        create_volume_preview(filepath, layout, n_slices_in_volume, normalize_func, save_path, preview_dic.get('bscan_step', 16),
+                              preview_dic.get('downsample', 4), preview_dic.get('columns', 8), preview_format)
+        print_loading_bar(file_idx + 1, len(files), 'Creating previews')
+    print()
+
+
+# Processing individual files (OLD FORMAT)
+def plan_individual_file_volumes(files: list[str], n_slices_in_volume: int, cycle_of_repeated_bscan: int) -> dict:
+    """Groups the sorted slice files into volumes and repeated B-scan slices, without reading them.
+
+    Returns:
+        dict: {id_volume: {id_slice: [filename, ...]}} in file order.
+    """
+    volume_files = {}
+    for counter, filename in enumerate(files):
+        id_volume = counter // n_slices_in_volume
+        id_slice = counter % cycle_of_repeated_bscan
+        volume_files.setdefault(id_volume, {}).setdefault(id_slice, []).append(filename)
+    return volume_files
+
+def read_individual_file(file_path: str, image_size: tuple) -> np.ndarray:
+    """Reads one little-endian float32 slice file, crops its first columns and rotates it."""
+    float_array = np.fromfile(file_path, dtype='<f4')
+    assert len(float_array) == image_size[0] * image_size[1], f"Error: float_array len ({len(float_array)}) must be equal to image_size - Height x Width ({image_size[0] * image_size[1]})"
+
+    image = float_array.reshape(image_size)
+    image = image[:, 10:]
+    return np.rot90(image, k=3)
+
+def process_individual_files_in_folder(folder: str, n_slices_in_volume: int, cycle_of_repeated_bscan: int, image_size: tuple, post_processing_average_per_n_slices: int, normalize_individual: bool, normalize_postprocessed: bool, normalize_func, save_folder: str, save_image: bool):
+    """Reads, averages and saves the slice files of the folder one volume at a time.
+
+    Incomplete volumes are detected from the file counts and skipped before anything is read,
+    so peak memory is a single volume instead of the whole dataset.
+    """
+    files = sort_filenames_by_number(os.listdir(folder))
+    volume_files = plan_individual_file_volumes(files, n_slices_in_volume, cycle_of_repeated_bscan)
+
+    # Filter incomplete volumes
+    n_primary_slices = n_slices_in_volume // cycle_of_repeated_bscan
+    for id_volume in list(volume_files):
+        if len(volume_files[id_volume].get(cycle_of_repeated_bscan - 1, [])) != n_primary_slices:
+            print(f"Deleting volume: {id_volume} - {id_volume * 500} because it doesn't have the required number of slices")
+            del volume_files[id_volume]
+
+    n_total_files = sum(len(slice_files) for slices in volume_files.values() for slice_files in slices.values())
+    counter_files = 0
+    height, width = image_size[1] - 10, image_size[0]
+    for id_volume, slices in volume_files.items():
+        for id_slice, slice_files in slices.items():
+            # Read the repeated B-scans of this slice into one stack
+            slice_stack = np.empty((len(slice_files), height, width), dtype=np.float32)
+            for idx, filename in enumerate(slice_files):
+                print_loading_bar(counter_files, n_total_files, 'Processing images')
+                counter_files += 1
+                image = read_individual_file(os.path.join(folder, filename), image_size)
+                if normalize_individual:
+                    image = normalize_func(image)
+                slice_stack[idx] = image
 
-    print_loading_bar(len(files), len(files), 'Reading images')  # Final update
-    print('\n')
-    return processed_volume_slices
-
-def filter_and_average_slices(processed_volume_slices: dict, cycle_of_repeated_bscan: int, n_primary_slices: int, post_processing_average_per_n_slices: int, normalize_postprocessed: bool, normalize_func, save_folder: str, save_image: bool):
-    """Filters, averages, and saves slices."""
-    volumes_to_remove = [id_volume for id_volume in processed_volume_slices if len(processed_volume_slices[id_volume][cycle_of_repeated_bscan - 1]) != n_primary_slices]
-    for id_volume in volumes_to_remove:
-        print(f"Deleting volume: {id_volume} - {id_volume * 500} because it doesn't have the required number of slices")
-        del processed_volume_slices[id_volume]
-
-    n_total_elements = int(count_total_elements(processed_volume_slices) / post_processing_average_per_n_slices)
-    counter_ele = 0
-    for id_volume in processed_volume_slices:
-        for id_slice in processed_volume_slices[id_volume]:
             if post_processing_average_per_n_slices > 1:
-                processed_volume_slices[id_volume][id_slice] = calculate_average_slices(
-                    processed_volume_slices[id_volume][id_slice], post_processing_average_per_n_slices
-                )
+                slice_stack = calculate_average_slices(slice_stack, post_processing_average_per_n_slices)
 
-            for counter, average_image in enumerate(processed_volume_slices[id_volume][id_slice]):
-                print_loading_bar(counter_ele, n_total_elements)
-                counter_ele += 1
+            for counter, average_image in enumerate(slice_stack):
                 if normalize_postprocessed:
                     average_image = normalize_func(average_image)
                 average_image = average_image.astype(np.uint8)
 
                 out_filename = f"{id_slice}_{counter}.png"
                 if save_image:
-                    image = Image.fromarray(average_image)
-                    save_path = os.path.join(save_folder, f"{id_volume}", out_filename)
-                    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                    image.save(save_path)
+                    save_bscan_image(average_image, os.path.join(save_folder, f"{id_volume}", out_filename))
                 else:
                     plt.imshow(average_image, cmap='gray')
                     plt.colorbar()
                     plt.title(f"Image {id_volume}_{out_filename}")
                     plt.show()
-    
+
     # Last iteraction
-    print_loading_bar(counter_ele, n_total_elements)
+    print_loading_bar(counter_files, n_total_files, 'Processing images')
+    print('\n')
 
 
 
 if __name__ == "__main__":
+    # Command line options (they take precedence over the configuration)
+    parser = argparse.ArgumentParser(description="Converts HoloOCT raw volumes into B-scan images.")
+    parser.add_argument('--shard', help="Convert only shard i of N of the large files, e.g. 0/4 (overrides shard in config.yaml)")
+    parser.add_argument('--merge-shards', type=int, metavar='N', help="Merge the manifests of an N-shard run and check that every batch output exists")
+    args = parser.parse_args()
+
     # Load configuration
     config = load_config('config.yaml')
 
@@ -300,20 +2014,29 @@ if __name__ == "__main__":
     save_image = config['save_image']
     multiple_files_per_file = config.get('multiple_files_per_file', False)
     data_format = config.get('data_format', 'float32')
-    post_processing_dic = config['post_process_image']
+    output_format = config.get('output_format', 'png')
+    raw_layout = config.get('raw_layout', {})
+    preview_dic = config.get('preview', {})
+    roi = config.get('roi', {})
 
     # Select normalization function based on data_format
-    if data_format == 'complex64':
+    if data_format.startswith('complex'):
         normalize_func = normalize_image_complex64
     else:
         normalize_func = normalize_image_float32
 
     # Process files
-    if multiple_files_per_file:
-        process_large_files_in_folder(folder, n_slices_in_volume, post_processing_average_per_n_slices, image_size, data_format, normalize_individual_image, normalize_postprocessed_images, normalize_func, post_processing_dic, save_folder, save_image)
+    if multiple_files_per_file and args.merge_shards:
+        # Check a sharded run once all its shards are done
+        first_bscan, last_bscan = roi.get('bscan_range') or (0, n_slices_in_volume)
+        n_batches = len(range(0, last_bscan - first_bscan, post_processing_average_per_n_slices))
+        missing = merge_shard_manifests(folder, save_folder, n_batches, args.merge_shards, output_format)
+        sys.exit(1 if missing else 0)
+    elif multiple_files_per_file and preview_dic.get('enabled', False):
+        # Quick look only, without registration or averaging
+        preview_large_files_in_folder(folder, n_slices_in_volume, image_size, data_format, normalize_func, save_folder, preview_dic, raw_layout)
+    elif multiple_files_per_file:
+        process_large_files_in_folder(get_large_file_settings(config, args.shard))
     else:
-        # Load and preprocess images in standard format
-        processed_volume_slices = load_and_preprocess_images(folder, n_slices_in_volume, cycle_of_repeated_bscan, image_size, normalize_individual_image, normalize_func)
-
-        # Filter and average slices, then save or display images
-        filter_and_average_slices(processed_volume_slices, cycle_of_repeated_bscan, n_slices_in_volume // cycle_of_repeated_bscan, post_processing_average_per_n_slices, normalize_postprocessed_images, normalize_func, save_folder, save_image)
+        # Read, average and save or display the slice files volume by volume
+        process_individual_files_in_folder(folder, n_slices_in_volume, cycle_of_repeated_bscan, image_size, post_processing_average_per_n_slices, normalize_individual_image, normalize_postprocessed_images, normalize_func, save_folder, save_image)